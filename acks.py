@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from telegram.error import TelegramError
+
+from config import ACK_EDIT_INTERVAL, ACK_QUIET
+
+
+# -----------------------------
+# Acknowledgements
+# -----------------------------
+# One status message per burst of files in a chat instead of one reply per
+# file. The first file of a burst gets a reply; later ones only update the
+# state, and a per-burst task edits the message at most every
+# ACK_EDIT_INTERVAL seconds. After ACK_QUIET seconds without files the burst
+# ends and the next file starts a new message.
+_bursts: dict[int, dict] = {}  # chat_id -> {"message", "files", "next", "last", "dirty", "task"}
+
+
+def _ack_text(burst: dict) -> str:
+	head = "✅ Caption added." if burst["files"] == 1 else f"✅ Captions added: {burst['files']} files."
+	return f"{head}\n{burst['next']}\n\n🙏 Please share this bot with your friends."
+
+
+async def ack(msg, files: int, next_line: str):
+	"""Report `files` captioned files (and what comes next) to msg's chat."""
+	chat_id = msg.chat_id
+	now = time.monotonic()
+	burst = _bursts.get(chat_id)
+	if burst is not None and now - burst["last"] <= ACK_QUIET:
+		burst["files"] += files
+		burst["next"] = next_line
+		burst["last"] = now
+		burst["dirty"] = True
+		return
+
+	if burst is not None and burst["task"]:
+		burst["task"].cancel()
+	burst = {"message": None, "files": files, "next": next_line, "last": now, "dirty": False, "task": None}
+	_bursts[chat_id] = burst
+	try:
+		burst["message"] = await msg.reply_text(_ack_text(burst))
+	except BaseException:
+		if _bursts.get(chat_id) is burst:
+			del _bursts[chat_id]
+		raise
+	burst["task"] = asyncio.create_task(_edit_loop(chat_id, burst))
+
+
+async def _edit_loop(chat_id: int, burst: dict):
+	try:
+		while True:
+			await asyncio.sleep(ACK_EDIT_INTERVAL)
+			if burst["dirty"]:
+				burst["dirty"] = False
+				try:
+					await burst["message"].edit_text(_ack_text(burst))
+				except TelegramError as e:
+					# Deleted by the user, or nothing to change: the burst is over
+					print(f"ack edit failed for {chat_id}: {e}")
+					break
+			elif time.monotonic() - burst["last"] > ACK_QUIET:
+				break
+	finally:
+		if _bursts.get(chat_id) is burst:
+			del _bursts[chat_id]
@@ -8,8 +8,11 @@ from config import (
 	add_force_channel,
 	remove_force_channel,
 	is_admin,
-	get_all_user_ids,
+	parse_segment,
+	count_broadcast_recipients,
+	create_broadcast_job,
 )
+from broadcast import start_broadcast
 
 
 def register_admin_handlers(application: Application):
@@ -106,78 +109,55 @@ def register_admin_handlers(application: Application):
 		if not await admin_only(update):
 			return
 
-		# Get broadcast message
-		if not context.args:
+		# Optional first argument: target segment (active:N days / joined:YYYY-MM-DD)
+		args = list(context.args or [])
+		segment = None
+		if args and ":" in args[0]:
+			try:
+				segment = parse_segment(args[0])
+				args = args[1:]
+			except ValueError:
+				pass  # just text that happens to contain ':'
+
+		# Get message to broadcast
+		broadcast_msg = update.message.reply_to_message
+		if not broadcast_msg and not args:
 			await update.message.reply_text(
 				"📢 *Broadcast Usage:*\n\n"
 				"Reply to a message with `/broadcast` to forward it to all users.\n"
-				"Or use: `/broadcast Your message here`",
+				"Or use: `/broadcast Your message here`\n\n"
+				"Target a segment with a first argument:\n"
+				"`active:7` — seen in the last 7 days\n"
+				"`joined:2024-01-31` — joined on/after that date",
 				parse_mode=ParseMode.MARKDOWN
 			)
 			return
-
-		# Get message to broadcast
-		broadcast_msg = None
-		if update.message.reply_to_message:
+		if broadcast_msg:
 			# Forward the replied message
-			broadcast_msg = update.message.reply_to_message
 			is_forward = True
 		else:
 			# Use the text after /broadcast
-			text = " ".join(context.args)
+			text = " ".join(args)
 			is_forward = False
 
-		# Get all user IDs
-		user_ids = await get_all_user_ids()
-		total = len(user_ids)
-
-		if total == 0:
+		recipients = await count_broadcast_recipients(segment)
+		if recipients == 0:
 			await update.message.reply_text("❌ No users found.")
 			return
 
-		# Confirm before sending
+		# The job runs in the background and keeps this message updated
 		status_msg = await update.message.reply_text(
-			f"📤 Broadcasting to {total} users...\n⏳ Please wait..."
+			f"📤 Broadcast queued for {recipients} users{f' ({segment})' if segment else ''}...\n"
+			"⏳ Progress will be shown here."
 		)
-
-		# Send to all users
-		success = 0
-		failed = 0
-		blocked = 0
-
-		for user_id in user_ids:
-			try:
-				if is_forward:
-					# Copy the message
-					await context.bot.copy_message(
-						chat_id=user_id,
-						from_chat_id=broadcast_msg.chat_id,
-						message_id=broadcast_msg.message_id
-					)
-				else:
-					# Send text message
-					await context.bot.send_message(
-						chat_id=user_id,
-						text=text,
-						parse_mode=ParseMode.MARKDOWN
-					)
-				success += 1
-			except Exception as e:
-				error_msg = str(e).lower()
-				if "blocked" in error_msg or "user is deactivated" in error_msg:
-					blocked += 1
-				else:
-					failed += 1
-
-		# Final report
-		report = (
-			f"✅ *Broadcast Complete*\n\n"
-			f"👥 Total: {total}\n"
-			f"✅ Success: {success}\n"
-			f"🚫 Blocked: {blocked}\n"
-			f"❌ Failed: {failed}"
-		)
-		await status_msg.edit_text(report, parse_mode=ParseMode.MARKDOWN)
+		if is_forward:
+			job_id = await create_broadcast_job(
+				update.effective_chat.id, status_msg.message_id,
+				from_chat_id=broadcast_msg.chat_id, message_id=broadcast_msg.message_id, segment=segment,
+			)
+		else:
+			job_id = await create_broadcast_job(update.effective_chat.id, status_msg.message_id, text=text, segment=segment)
+		start_broadcast(context.bot, job_id)
 
 	application.add_handler(CommandHandler("forceon", forceon_cmd))
 	application.add_handler(CommandHandler("forceoff", forceoff_cmd))
@@ -1,17 +1,18 @@
 import asyncio
 import os
-import tempfile
 import time
-from typing import List
 
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, BotCommand, InputFile
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, BotCommand
 from telegram.constants import ParseMode
+from telegram.error import TelegramError
 from telegram.ext import (
 	Application,
 	CommandHandler,
 	MessageHandler,
 	CallbackQueryHandler,
+	ChatMemberHandler,
 	ConversationHandler,
+	TypeHandler,
 	ContextTypes,
 	filters,
 )
@@ -19,22 +20,33 @@ from telegram.ext import (
 from config import (
 	BOT_TOKEN,
 	START_TIME,
+	ALBUM_WINDOW,
 	init_db,
+	close_db,
+	transaction,
 	track_user,
 	is_admin,
 	get_user,
 	set_user,
 	list_captions,
+	list_captions_page,
+	captions_page_before,
+	count_captions,
 	get_active_caption_id,
 	get_caption,
 	set_active_caption_id,
 	build_caption,
 	set_caption_fields,
+	reserve_episodes,
+	release_episodes,
 	update_stats,
 	get_total_users,
 	get_user_stats,
 	get_all_user_ids,
 	get_stats,
+	get_user_cache_stats,
+	get_transfer_stats,
+	record_transfer,
 	get_force_config,
 	format_uptime,
 	format_bytes,
@@ -42,6 +54,7 @@ from config import (
 	parse_settemplate_values,
 	check_user_joined,
 	clear_force_join_cache,
+	record_chat_member,
 	build_join_buttons,
 	add_caption,
     delete_caption,
@@ -52,14 +65,20 @@ from config import (
     build_final_filename,
 	get_multi_state,
 	set_multi_enabled,
-	set_multi_ids,
 	clear_multi,
 	toggle_multi_id,
 	advance_multi_pointer,
+	rewind_multi_pointer,
+	load_media_context,
 	HELP_URL,
 )
 
 from admin import register_admin_handlers
+from transfer import resend_document, resend_document_group, copy_media_group, submit, start_workers, stop_workers, queue_stats
+from updates import PerUserUpdateProcessor, user_lock
+from acks import ack
+from outbound import OutboundLimiter, PRIORITY_MEDIA
+from broadcast import resume_broadcasts, stop_broadcasts
 
 
 def kb_home():
@@ -90,24 +109,47 @@ def kb_caption_actions(cid, name: str, next_ep: int):
 	])
 
 
-def kb_list(caps: List[dict], page: int, page_size: int = 10):
-	total = len(caps)
-	start = (page - 1) * page_size
-	end = start + page_size
-	chunk = caps[start:end]
+CAPTIONS_PAGE_SIZE = 10
+
+
+async def load_caption_page(uid: int, anchor: int = 0, page_size: int = CAPTIONS_PAGE_SIZE) -> dict:
+	"""Keyset page of a user's captions: rows plus the cursors for Prev/Next"""
+	rows = await list_captions_page(uid, after_id=anchor, limit=page_size + 1)
+	if anchor and not rows:
+		# Stale cursor (caption deleted or an old button): restart from the top
+		anchor = 0
+		rows = await list_captions_page(uid, limit=page_size + 1)
+	has_next = len(rows) > page_size
+	rows = rows[:page_size]
+	prev = await captions_page_before(uid, rows[0]["_id"], page_size) if anchor and rows else None
+	return {"rows": rows, "anchor": anchor, "prev": prev, "next": rows[-1]["_id"] if has_next else None}
+
+
+def _page_anchor(data: str) -> int:
+	# "<prefix>:pg:<after_id>" pages by cursor; legacy "<prefix>:list:<n>" opens the first page
+	parts = data.split(":")
+	if len(parts) >= 3 and parts[1] == "pg":
+		try:
+			return int(parts[2])
+		except ValueError:
+			pass
+	return 0
+
+
+def kb_list(page: dict):
 	btn_rows = []
-	for doc in chunk:
+	for doc in page["rows"]:
 		label = f"{doc['name']} — {doc.get('version') or '—'} — {doc.get('lang') or '—'} (next: {doc.get('next_ep', 1)})"
 		btn_rows.append([InlineKeyboardButton(label[:64], callback_data=f"cap:open:{doc['_id']}")])
 	nav = []
-	if start > 0:
-		nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"cap:list:{page-1}"))
-	if end < total:
-		nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"cap:list:{page+1}"))
+	if page["prev"] is not None:
+		nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"cap:pg:{page['prev']}"))
+	if page["next"] is not None:
+		nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"cap:pg:{page['next']}"))
 	if nav:
 		btn_rows.append(nav)
 	# Multi-select entry
-	btn_rows.append([InlineKeyboardButton("🎯 Multi-select", callback_data=f"mc:list:{page}")])
+	btn_rows.append([InlineKeyboardButton("🎯 Multi-select", callback_data=f"mc:pg:{page['anchor']}")])
 	btn_rows.append([InlineKeyboardButton("🏠 Home", callback_data="home")])
 	return InlineKeyboardMarkup(btn_rows)
 
@@ -118,11 +160,7 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	except Exception:
 		pass
 	user_id = update.effective_user.id
-	# Track user (best effort)
-	try:
-		await track_user(user_id)
-	except Exception as e:
-		print(f"track_user failed: {e}")
+	# Activity is tracked for every update by track_activity (group -1)
 	# Force-join (best effort)
 	try:
 		if not is_admin(user_id):
@@ -188,24 +226,28 @@ async def settemplate_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 		series, ep, zero_pad, version, lang = parsed
 		# Set standard template (no dashes, double spaces as requested)
 		tpl = "{series} Episode {ep}  {version}  {lang}"
-		await set_user(user_id, template=tpl)
-		# Create/activate the corresponding caption
-		ok, msg, cid = await add_caption(user_id, series, version, lang)
-		if not ok and cid:
-			pass
-		elif not ok and "exists" in msg or "existe" in msg:
-			caps = await list_captions(user_id)
-			from config import norm
-			found = next((c for c in caps if norm(c.get("name",""))==norm(series) and norm(c.get("version",""))==norm(version) and norm(c.get("lang",""))==norm(lang)), None)
-			cid = found["_id"] if found else None
-			if not cid:
-				await update.message.reply_text("⚠️ Existing caption not found. Try again.")
-				return
-		elif not ok:
-			await update.message.reply_text(msg)
+		error = None
+		async with transaction():
+			await set_user(user_id, template=tpl)
+			# Create/activate the corresponding caption
+			ok, msg, cid = await add_caption(user_id, series, version, lang)
+			if not ok and cid:
+				pass
+			elif not ok and "exists" in msg or "existe" in msg:
+				caps = await list_captions(user_id)
+				from config import norm
+				found = next((c for c in caps if norm(c.get("name",""))==norm(series) and norm(c.get("version",""))==norm(version) and norm(c.get("lang",""))==norm(lang)), None)
+				cid = found["_id"] if found else None
+				if not cid:
+					error = "⚠️ Existing caption not found. Try again."
+			elif not ok:
+				error = msg
+			if not error:
+				await set_active_caption_id(user_id, cid)
+				await set_caption_fields(user_id, cid, next_ep=int(ep), zero_pad=int(zero_pad))
+		if error:
+			await update.message.reply_text(error)
 			return
-		await set_active_caption_id(user_id, cid)
-		await set_caption_fields(user_id, cid, next_ep=int(ep), zero_pad=int(zero_pad))
 		await update.message.reply_text(
 			"✅ Template saved and active caption prepared.\n"
 			f"• Series: `{series}`\n"
@@ -246,27 +288,32 @@ async def captions_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 				parse_mode=ParseMode.MARKDOWN,
 			)
 			return
-	caps = await list_captions(user_id)
-	if not caps:
+	page = await load_caption_page(user_id)
+	if not page["rows"]:
 		await update.message.reply_text("Empty list. Use /settemplate to create a caption.")
 		return
-	await update.message.reply_text("🗂 *Caption List*:", reply_markup=kb_list(caps, page=1), parse_mode=ParseMode.MARKDOWN)
+	total = await count_captions(user_id)
+	await update.message.reply_text(f"🗂 *Caption List* ({total}):", reply_markup=kb_list(page), parse_mode=ParseMode.MARKDOWN)
 
 
 async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	user_id = update.effective_user.id
 	act = await get_active_caption_id(user_id)
 	cap = await get_caption(user_id, act) if act else None
-	my_caps = await list_captions(user_id)
+	my_caps = await count_captions(user_id)
 	parts = [
 		"👤 *Your status*",
-		f"• Captions: {len(my_caps)}",
+		f"• Captions: {my_caps}",
 		"• Active: " + (f"**{cap['name']}** — {cap.get('version') or '—'} — {cap.get('lang') or '—'} (next: {cap.get('next_ep', 1)})" if cap else "none"),
 	]
 	if is_admin(user_id):
 		user_stats = await get_user_stats()
 		force = await get_force_config()
 		stats = await get_stats()
+		cache = get_user_cache_stats()
+		transfer = get_transfer_stats()
+		outbound = context.bot.rate_limiter.stats()
+		queue = queue_stats()
 		uptime = format_uptime(time.time() - START_TIME)
 		parts += [
 			"",
@@ -281,6 +328,12 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 			f"• Files: {stats['files']}",
 			f"• Storage: {format_bytes(stats['storage_bytes'])}",
 			f"• Force: {'ON' if force.get('enabled') else 'OFF'} ({len(force.get('channels', []))})",
+			f"• User cache: {cache['users']} users, {format_bytes(cache['bytes'])}, hit rate {cache['hit_rate']:.0%}",
+			f"• Sends: {transfer['reuse']} reused, {transfer['cached']} cached, {transfer['upload']} uploaded, {transfer['copy']} copied",
+			f"• Transfer: {format_bytes(transfer['bytes'])} moved, {format_bytes(transfer['saved_bytes'])} saved",
+			f"• Transfer queue: {queue['queued']} queued, {queue['running']} running, {format_bytes(queue['bytes'])} in flight",
+			f"• Outbound: {outbound['queued']} queued, {outbound['sent']} sent, "
+			f"wait avg {outbound['avg_wait']:.2f}s / max {outbound['max_wait']:.1f}s, {outbound['retries']} flood retries",
 			f"• Uptime: {uptime}",
 		]
 	await update.message.reply_text("\n".join(parts), parse_mode=ParseMode.MARKDOWN)
@@ -437,9 +490,10 @@ async def use_caption_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	if not cap:
 		await cq.message.edit_text("⚠️ Caption not found.")
 		return
-	if mode == "start":
-		await set_caption_fields(uid, cid, next_ep=1)
-	await set_active_caption_id(uid, cid)
+	async with transaction():
+		if mode == "start":
+			await set_caption_fields(uid, cid, next_ep=1)
+		await set_active_caption_id(uid, cid)
 	await cq.message.edit_text(
 		"✅ Caption activated.\n"
 		f"• **{cap['name']}** — {cap.get('version') or '—'} — {cap.get('lang') or '—'} "
@@ -453,33 +507,32 @@ async def delete_caption_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	await cq.answer()
 	uid = cq.from_user.id
 	cid = int(cq.data.split(":")[2])
-	act = await get_active_caption_id(uid)
-	if act == cid:
-		await set_active_caption_id(uid, None)
-	ok = await delete_caption(uid, cid)
+	async with transaction():
+		act = await get_active_caption_id(uid)
+		if act == cid:
+			await set_active_caption_id(uid, None)
+		ok = await delete_caption(uid, cid)
 	if not ok:
 		await cq.message.edit_text("ℹ️ Nothing to delete.")
 		return
-	caps = await list_captions(uid)
-	if not caps:
+	page = await load_caption_page(uid)
+	if not page["rows"]:
 		await cq.message.edit_text("Empty list.")
 		return
-	await cq.message.edit_text("🗂 *Caption List*:", reply_markup=kb_list(caps, page=1), parse_mode=ParseMode.MARKDOWN)
+	total = await count_captions(uid)
+	await cq.message.edit_text(f"🗂 *Caption List* ({total}):", reply_markup=kb_list(page), parse_mode=ParseMode.MARKDOWN)
 
 
 async def list_captions_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	cq = update.callback_query
 	await cq.answer()
 	uid = cq.from_user.id
-	try:
-		page = int(cq.data.split(":")[2])
-	except Exception:
-		page = 1
-	caps = await list_captions(uid)
-	if not caps:
+	page = await load_caption_page(uid, _page_anchor(cq.data))
+	if not page["rows"]:
 		await cq.message.edit_text("Empty list.")
 		return
-	await cq.message.edit_text("🗂 *Caption List*:", reply_markup=kb_list(caps, page=page), parse_mode=ParseMode.MARKDOWN)
+	total = await count_captions(uid)
+	await cq.message.edit_text(f"🗂 *Caption List* ({total}):", reply_markup=kb_list(page), parse_mode=ParseMode.MARKDOWN)
 
 
 # -----------------------------
@@ -490,32 +543,22 @@ def _mc_label(doc: dict, checked: bool) -> str:
 	return f"{box} {doc['name']} — {doc.get('version') or '—'} — {doc.get('lang') or '—'}"
 
 
-async def mc_list_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-	cq = update.callback_query; await cq.answer()
-	uid = cq.from_user.id
-	try:
-		page = int(cq.data.split(":")[2])
-	except Exception:
-		page = 1
-
-	caps = await list_captions(uid)
+async def _render_mc_list(cq, uid: int, anchor: int = 0):
+	page = await load_caption_page(uid, anchor)
 	st = await get_multi_state(uid)
 	selected = set(st["ids"])
-
-	total = len(caps); page_size = 10
-	start = (page - 1) * page_size; end = start + page_size
-	chunk = caps[start:end]
+	anchor = page["anchor"]
 
 	rows = []
-	for doc in chunk:
+	for doc in page["rows"]:
 		checked = doc["_id"] in selected
-		rows.append([InlineKeyboardButton(_mc_label(doc, checked)[:64], callback_data=f"mc:tg:{doc['_id']}:{page}")])
+		rows.append([InlineKeyboardButton(_mc_label(doc, checked)[:64], callback_data=f"mc:tg:{doc['_id']}:{anchor}")])
 
 	nav = []
-	if start > 0:
-		nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"mc:list:{page-1}"))
-	if end < total:
-		nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"mc:list:{page+1}"))
+	if page["prev"] is not None:
+		nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"mc:pg:{page['prev']}"))
+	if page["next"] is not None:
+		nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"mc:pg:{page['next']}"))
 	if nav:
 		rows.append(nav)
 
@@ -526,23 +569,26 @@ async def mc_list_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	await cq.message.edit_text(txt, reply_markup=InlineKeyboardMarkup(rows), parse_mode=ParseMode.MARKDOWN)
 
 
+async def mc_list_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+	cq = update.callback_query; await cq.answer()
+	await _render_mc_list(cq, cq.from_user.id, _page_anchor(cq.data))
+
+
 async def mc_toggle_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	cq = update.callback_query; await cq.answer()
 	uid = cq.from_user.id
-	_, _, cid_str, page_str = cq.data.split(":")
-	cid = int(cid_str); page = int(page_str)
+	_, _, cid_str, anchor_str = cq.data.split(":")
+	cid = int(cid_str); anchor = int(anchor_str)
 	await toggle_multi_id(uid, cid)
 	# refresh same page
-	cq.data = f"mc:list:{page}"
-	await mc_list_cb(update, context)
+	await _render_mc_list(cq, uid, anchor)
 
 
 async def mc_clear_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	cq = update.callback_query; await cq.answer()
 	uid = cq.from_user.id
 	await clear_multi(uid)
-	cq.data = "mc:list:1"
-	await mc_list_cb(update, context)
+	await _render_mc_list(cq, uid)
 
 
 async def mc_start_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -552,11 +598,11 @@ async def mc_start_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	n = len(st["ids"])
 	if n < 2 or n > 10:
 		await cq.answer("Choose between 2 and 10 captions.", show_alert=True)
-		cq.data = "mc:list:1"
-		await mc_list_cb(update, context)
+		await _render_mc_list(cq, uid)
 		return
-	await set_multi_enabled(uid, True)
-	await set_active_caption_id(uid, None)
+	async with transaction():
+		await set_multi_enabled(uid, True)
+		await set_active_caption_id(uid, None)
 	await cq.message.edit_text(f"✅ Multi-caption *enabled* ({n} selected). Send your files.", parse_mode=ParseMode.MARKDOWN)
 
 async def on_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -579,82 +625,123 @@ async def on_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
 			)
 			return
 
+	# Albums are collected and handled as one batch; whatever this user sent
+	# before (an album still in its window) is reserved first
+	await _flush_user_albums(context.bot, user_id, keep=msg.media_group_id)
+	if msg.media_group_id:
+		collect_album(context.bot, user_id, msg)
+		return
+
+	# Template, tag prefs, active/multi state and target caption in one lookup
+	ctx = await load_media_context(user_id)
+
 	# Priorité au mode multi-caption si activé
-	st = await get_multi_state(user_id)
+	st = ctx["multi"]
 	use_multi = bool(st.get("enabled") and st.get("ids"))
-	if use_multi:
-		ids = st["ids"]
-		ptr = st.get("pointer", 0) % len(ids)
-		cid = int(ids[ptr])
-		cap = await get_caption(user_id, cid)
-		if not cap:
-			# remove missing id and retry
-			ids = [x for x in ids if x != cid]
-			await set_multi_ids(user_id, ids)
-			if not ids:
-				await set_multi_enabled(user_id, False)
-				await msg.reply_text("ℹ️ Multi-captions are empty. Use /captions → 🎯 Multi-select.")
-				return
-			await on_media(update, context)
-			return
-	else:
+	if not use_multi:
 		# Légende active requise
-		cid = await get_active_caption_id(user_id)
+		cid = ctx["active_caption_id"]
 		if not cid:
 			await msg.reply_text("⚠️ No active caption. Use `/captions`.", parse_mode=ParseMode.MARKDOWN)
 			return
-		cap = await get_caption(user_id, cid)
+		cap = ctx["caption"]
 		if not cap:
 			await set_active_caption_id(user_id, None)
 			await msg.reply_text("⚠️ Caption not found.")
 			return
 
-	u = await get_user(user_id)
+	# Rotation slot and episode number in one unit of work: one commit, and a
+	# caption gone in the meantime rolls the rotation back with it
+	multi_ptr = None
+	rotation_empty = False
+	try:
+		async with transaction():
+			if use_multi:
+				# Take the caption at the rotation pointer and advance it in one statement
+				claimed = await advance_multi_pointer(user_id)
+				if not claimed:
+					rotation_empty = True
+					raise LookupError("ℹ️ Multi-captions are empty. Use /captions → 🎯 Multi-select.")
+				cid, multi_ptr = claimed
+				cap = ctx["caption"] if ctx["caption_id"] == cid else await get_caption(user_id, cid)
+			# Reserve the episode number up front so concurrent files never share one
+			ep = await reserve_episodes(user_id, cid) if cap else None
+			if ep is None:
+				raise LookupError("⚠️ Caption not found.")
+	except LookupError as e:
+		if rotation_empty:
+			await set_multi_enabled(user_id, False)
+		await msg.reply_text(str(e))
+		return
+
 	caption = build_caption(
-		u["template"],
+		ctx["template"],
 		cap["name"],
-		int(cap.get("next_ep", 1)),
+		ep,
 		int(cap.get("zero_pad", 0)),
 		cap.get("version") or "",
 		cap.get("lang") or ""
 	)
 
 	# Appliquer le hashtag/username auto
-	prefs = await get_user_tag_prefs(user_id)
+	prefs = ctx["prefs"]
 	caption = apply_tag_to_caption(caption, prefs.get("tag"), prefs.get("position"))
 
+	# The send runs on the transfer workers; the handler returns right away
+	size = (msg.document.file_size or 0) if msg.document else 0
+	pointers = [multi_ptr] if multi_ptr is not None else []
+	submit(
+		user_id, size,
+		lambda: deliver_media(context.bot, msg, cid, ep, caption, prefs, multi_ptr),
+		lambda: _abandon(msg, user_id, [(cid, ep, 1)], pointers),
+	)
+
+
+async def _give_back(user_id: int, reservations: list, pointers: list):
+	"""Hand back the episode numbers and rotation slots of a send that never went out, newest first."""
+	try:
+		async with transaction():
+			for cid, start, n in reversed(reservations):
+				await release_episodes(user_id, cid, start, n)
+			for ptr in reversed(pointers):
+				await rewind_multi_pointer(user_id, ptr)
+	except Exception:
+		pass
+
+
+async def _abandon(msg, user_id: int, reservations: list, pointers: list):
+	"""A transfer job dropped at shutdown: give its reservations back and tell the chat."""
+	await _give_back(user_id, reservations, pointers)
+	try:
+		await msg.reply_text("⚠️ The bot restarted before this was sent. Please send it again.")
+	except TelegramError:
+		pass
+
+
+async def deliver_media(bot, msg, cid: int, ep: int, caption: str, prefs: dict, multi_ptr):
+	"""Transfer job: send the captioned media back and report to the chat."""
+	user_id = msg.from_user.id
 	# Selon le type: pour les documents on renvoie avec un nom de fichier final,
 	# sinon on copie simplement le message avec la légende mise à jour
+	sent = False
 	try:
 		if msg.document:
 			original_name = msg.document.file_name or "file"
-			final_name = await build_final_filename(user_id, original_name)
-			# Télécharge le fichier puis renvoie avec le nom final
-			file = await msg.document.get_file()
-			tmp_path = os.path.join(
-				tempfile.gettempdir(), f"acb_{msg.document.file_unique_id}_{final_name}"
-			)
-			await file.download_to_drive(custom_path=tmp_path)
-			try:
-				await context.bot.send_document(
-					chat_id=msg.chat_id,
-					document=InputFile(tmp_path, filename=final_name),
-					caption=caption,
-				)
-			finally:
-				try:
-					os.remove(tmp_path)
-				except Exception:
-					pass
+			final_name = await build_final_filename(user_id, original_name, prefs=prefs)
+			# Renvoie avec le nom final (file_id réutilisé si possible, sinon transfert)
+			await resend_document(bot, msg.chat_id, msg.document, final_name, caption)
 		else:
-			await context.bot.copy_message(
+			await bot.copy_message(
 				chat_id=msg.chat_id,
 				from_chat_id=msg.chat_id,
 				message_id=msg.message_id,
-				caption=caption
+				caption=caption,
+				rate_limit_args=PRIORITY_MEDIA,
 			)
+			record_transfer("copy")
+		sent = True
 
-		# Stats & episode increment
+		# Stats
 		file_size = (
 			(msg.document and msg.document.file_size) or
 			(msg.video and msg.video.file_size) or
@@ -663,19 +750,197 @@ async def on_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
 			0
 		)
 		await update_stats(files_delta=1, bytes_delta=file_size)
-		await set_caption_fields(user_id, cid, next_ep=int(cap.get("next_ep", 1)) + 1)
-		if use_multi:
-			await advance_multi_pointer(user_id)
 
-		# (Optional) ack text
-		await msg.reply_text(
-			f"✅ Caption added.\n➡️ Next episode: {int(cap.get('next_ep', 1))+1}\n\n🙏 Please share this bot with your friends."
-		)
+		# Ack, coalesced per burst into one edited message
+		await ack(msg, 1, f"➡️ Next episode: {ep + 1}")
 
+	except asyncio.CancelledError:
+		# Shutdown ran out of time before the send
+		if not sent:
+			await _abandon(msg, user_id, [(cid, ep, 1)], [multi_ptr] if multi_ptr is not None else [])
+		raise
 	except Exception as e:
+		if not sent:
+			# Nothing went out: hand the episode number and rotation slot back if still possible
+			await _give_back(user_id, [(cid, ep, 1)], [multi_ptr] if multi_ptr is not None else [])
 		await msg.reply_text(f"❌ Error: `{e}`", parse_mode=ParseMode.MARKDOWN)
 
 
+# Albums being collected: {(user_id, media_group_id): [messages]}.
+# Each new item restarts the ALBUM_WINDOW timer; when it fires the whole album
+# is reserved and sent back with a single send_media_group. Albums are only
+# touched under their user's lock (on_media already holds it), and any later
+# file or album from the same user flushes the pending ones first, so episodes
+# are reserved in the order the user sent things.
+_albums: dict[tuple, list] = {}
+_album_timers: dict[tuple, asyncio.Task] = {}
+
+
+def collect_album(bot, user_id: int, msg):
+	key = (user_id, msg.media_group_id)
+	_albums.setdefault(key, []).append(msg)
+	timer = _album_timers.get(key)
+	if timer:
+		timer.cancel()
+	_album_timers[key] = asyncio.create_task(_flush_album_later(bot, key))
+
+
+async def _flush_album_later(bot, key: tuple):
+	try:
+		await asyncio.sleep(ALBUM_WINDOW)
+		# Nothing left to do if a later file of this user flushed the album already
+		async with user_lock(key[0]):
+			await _flush_album(bot, key)
+	finally:
+		if _album_timers.get(key) is asyncio.current_task():
+			del _album_timers[key]
+
+
+async def _flush_user_albums(bot, user_id: int, keep=None):
+	"""Reserve user_id's pending albums (except media group `keep`) now. Caller holds the user's lock."""
+	for key in [k for k in _albums if k[0] == user_id and k[1] != keep]:
+		timer = _album_timers.pop(key, None)
+		if timer:
+			timer.cancel()
+		await _flush_album(bot, key)
+
+
+async def flush_albums(bot):
+	"""Shutdown: reserve and queue the albums still being collected without waiting out their window."""
+	# Users with a timer too: one past its window may be reserving right now
+	for user_id in {key[0] for key in _albums} | {key[0] for key in _album_timers}:
+		async with user_lock(user_id):
+			await _flush_user_albums(bot, user_id)
+	for timer in list(_album_timers.values()):
+		timer.cancel()
+
+
+async def _flush_album(bot, key: tuple):
+	msgs = _albums.pop(key, None)
+	if not msgs:
+		return
+	msgs.sort(key=lambda m: m.message_id)
+	try:
+		await _reserve_album(bot, key[0], msgs)
+	except Exception as e:
+		await msgs[0].reply_text(f"❌ Error: `{e}`", parse_mode=ParseMode.MARKDOWN)
+
+
+async def _reserve_album(bot, user_id: int, msgs: list):
+	ctx = await load_media_context(user_id)
+	st = ctx["multi"]
+	use_multi = bool(st.get("enabled") and st.get("ids"))
+	if not use_multi:
+		cid = ctx["active_caption_id"]
+		if not cid:
+			await msgs[0].reply_text("⚠️ No active caption. Use `/captions`.", parse_mode=ParseMode.MARKDOWN)
+			return
+		if not ctx["caption"]:
+			await set_active_caption_id(user_id, None)
+			await msgs[0].reply_text("⚠️ Caption not found.")
+			return
+
+	# Rotation slots and episode numbers for the whole album in one unit of work;
+	# episodes are reserved per caption in one statement, handed out in message_id order
+	error = None
+	try:
+		async with transaction():
+			if use_multi:
+				claims = []
+				for _ in msgs:
+					claimed = await advance_multi_pointer(user_id)
+					if not claimed:
+						raise LookupError("ℹ️ Multi-captions are empty. Use /captions → 🎯 Multi-select.")
+					claims.append(claimed)
+			else:
+				claims = [(cid, None)] * len(msgs)
+			counts = {}
+			for claim_cid, _ in claims:
+				counts[claim_cid] = counts.get(claim_cid, 0) + 1
+			caps, next_ep, reservations = {}, {}, []
+			for claim_cid, n in counts.items():
+				cap = ctx["caption"] if ctx["caption_id"] == claim_cid else await get_caption(user_id, claim_cid)
+				start = await reserve_episodes(user_id, claim_cid, n) if cap else None
+				if start is None:
+					raise LookupError("⚠️ Caption not found.")
+				caps[claim_cid] = cap
+				next_ep[claim_cid] = start
+				reservations.append((claim_cid, start, n))
+	except LookupError as e:
+		error = str(e)
+	if error:
+		await msgs[0].reply_text(error)
+		return
+
+	prefs = ctx["prefs"]
+	captions = []
+	for claim_cid, _ in claims:
+		cap = caps[claim_cid]
+		caption = build_caption(
+			ctx["template"],
+			cap["name"],
+			next_ep[claim_cid],
+			int(cap.get("zero_pad", 0)),
+			cap.get("version") or "",
+			cap.get("lang") or ""
+		)
+		captions.append(apply_tag_to_caption(caption, prefs.get("tag"), prefs.get("position")))
+		next_ep[claim_cid] += 1
+
+	pointers = [ptr for _, ptr in claims if ptr is not None]
+	summary = [(caps[c]["name"], next_ep[c]) for c in counts]
+	size = sum((m.document.file_size or 0) for m in msgs if m.document)
+	submit(
+		user_id, size,
+		lambda: deliver_album(bot, msgs, captions, prefs, reservations, pointers, summary),
+		lambda: _abandon(msgs[0], user_id, reservations, pointers),
+	)
+
+
+async def deliver_album(bot, msgs: list, captions: list, prefs: dict, reservations: list, pointers: list, summary: list):
+	"""Transfer job: send a whole album back with one send_media_group and one summary reply."""
+	user_id = msgs[0].from_user.id
+	chat_id = msgs[0].chat_id
+	sent = False
+	try:
+		if all(m.document for m in msgs):
+			items = []
+			for m, caption in zip(msgs, captions):
+				final_name = await build_final_filename(user_id, m.document.file_name or "file", prefs=prefs)
+				items.append((m.document, final_name, caption))
+			await resend_document_group(bot, chat_id, items)
+		else:
+			await copy_media_group(bot, chat_id, msgs, captions)
+		sent = True
+
+		# Stats
+		file_size = sum(
+			(m.document and m.document.file_size) or
+			(m.video and m.video.file_size) or
+			(m.photo and m.photo[-1].file_size) or
+			0
+			for m in msgs
+		)
+		await update_stats(files_delta=len(msgs), bytes_delta=file_size)
+
+		if len(summary) == 1:
+			next_line = f"➡️ Next episode: {summary[0][1]}"
+		else:
+			next_line = "➡️ Next episodes:\n" + "\n".join(f"• {name}: {ep}" for name, ep in summary)
+		await ack(msgs[0], len(msgs), next_line)
+
+	except asyncio.CancelledError:
+		# Shutdown ran out of time before the send
+		if not sent:
+			await _abandon(msgs[0], user_id, reservations, pointers)
+		raise
+	except Exception as e:
+		if not sent:
+			# Nothing went out: give the episode numbers and rotation slots back
+			await _give_back(user_id, reservations, pointers)
+		await msgs[0].reply_text(f"❌ Error: `{e}`", parse_mode=ParseMode.MARKDOWN)
+
+
 async def fs_refresh_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	if not update.callback_query:
 		return
@@ -694,6 +959,22 @@ async def fs_refresh_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	await cq.answer()
 
 
+async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+	# Join/leave events from forced channels (bot must be admin there) keep the
+	# force-join cache current without polling get_chat_member
+	cmu = update.chat_member
+	if not cmu:
+		return
+	member = cmu.new_chat_member
+	await record_chat_member(cmu.chat.id, member.user.id, member.status)
+
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+	# Runs before every handler group; track_user only records in memory
+	if update.effective_user and (update.message or update.callback_query):
+		await track_user(update.effective_user.id)
+
+
 async def debug_trap(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	try:
 		if os.getenv("DEBUG", "0") == "1" and is_admin(update.effective_user.id):
@@ -714,6 +995,10 @@ async def echo_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def post_init(application: Application):
+	# Open the database on the application's event loop (reader pool included)
+	await init_db()
+	start_workers()
+	await resume_broadcasts(application.bot)
 	# Set bot commands (menu) and print bot identity
 	cmds = [
 		BotCommand("start", "Start the bot"),
@@ -735,10 +1020,34 @@ async def post_init(application: Application):
 	print(f"Auto-Caption Bot started as @{me.username} (id={me.id})")
 
 
+async def post_stop(application: Application):
+	# The bot can still send here (post_shutdown runs after it is shut down):
+	# queue pending albums, let the transfer workers drain, pause broadcasts
+	await flush_albums(application.bot)
+	await stop_workers()
+	await stop_broadcasts()
+
+
+async def post_shutdown(application: Application):
+	await close_db()
+
+
 def main():
-	# Initialize database (async) before starting polling
-	asyncio.run(init_db())
-	application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+	# The database is initialized in post_init so every connection lives on the polling loop.
+	# Updates run concurrently across users and in order for each user.
+	application = (
+		Application.builder()
+		.token(BOT_TOKEN)
+		.concurrent_updates(PerUserUpdateProcessor())
+		.rate_limiter(OutboundLimiter())
+		.post_init(post_init)
+		.post_stop(post_stop)
+		.post_shutdown(post_shutdown)
+		.build()
+	)
+
+	# Activity tracking for every interaction (debounced, flushed in bulk)
+	application.add_handler(TypeHandler(Update, track_activity), group=-1)
 
 	# Register command handlers
 	application.add_handler(CommandHandler("start", start_cmd))
@@ -780,17 +1089,18 @@ def main():
 
 	# Callback queries
 	application.add_handler(CallbackQueryHandler(fs_refresh_cb, pattern=r"^fs:refresh$"))
+	application.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.CHAT_MEMBER))
 	application.add_handler(CallbackQueryHandler(settings_home_cb, pattern=r"^set:home$"))
 	application.add_handler(CallbackQueryHandler(settings_toggle_pos_cb, pattern=r"^set:pos$"))
 	application.add_handler(CallbackQueryHandler(settings_remove_hashtag_cb, pattern=r"^set:rm$"))
 	application.add_handler(CallbackQueryHandler(home_cb, pattern=r"^home$"))
 	application.add_handler(CallbackQueryHandler(noop_cb, pattern=r"^noop$"))
-	application.add_handler(CallbackQueryHandler(list_captions_cb, pattern=r"^cap:list:\d+$"))
+	application.add_handler(CallbackQueryHandler(list_captions_cb, pattern=r"^cap:(list|pg):\d+$"))
 	application.add_handler(CallbackQueryHandler(open_caption_cb, pattern=r"^cap:open:\d+$"))
 	application.add_handler(CallbackQueryHandler(use_caption_cb, pattern=r"^cap:use:\d+:(cont|start)$"))
 	application.add_handler(CallbackQueryHandler(delete_caption_cb, pattern=r"^cap:del:\d+$"))
 	# Multi-caption handlers
-	application.add_handler(CallbackQueryHandler(mc_list_cb, pattern=r"^mc:list:\d+$"))
+	application.add_handler(CallbackQueryHandler(mc_list_cb, pattern=r"^mc:(list|pg):\d+$"))
 	application.add_handler(CallbackQueryHandler(mc_toggle_cb, pattern=r"^mc:tg:\d+:\d+$"))
 	application.add_handler(CallbackQueryHandler(mc_clear_cb, pattern=r"^mc:clear$"))
 	application.add_handler(CallbackQueryHandler(mc_start_cb, pattern=r"^mc:start$"))
@@ -804,7 +1114,8 @@ def main():
 	application.add_handler(MessageHandler(filters.ChatType.PRIVATE, echo_all))
 
 	# Run bot (blocking)
-	application.run_polling()
+	# chat_member updates are only delivered when explicitly requested
+	application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,181 @@
+import asyncio
+import time
+from datetime import timedelta
+
+from telegram.constants import ParseMode
+from telegram.error import Forbidden, RetryAfter, TelegramError
+
+from config import (
+	BROADCAST_CHUNK,
+	BROADCAST_CONCURRENCY,
+	BROADCAST_STATUS_INTERVAL,
+	iter_user_id_chunks,
+	get_broadcast_job,
+	list_running_broadcasts,
+	record_broadcast_chunk,
+	finish_broadcast_job,
+)
+from outbound import PRIORITY_BULK
+
+
+# -----------------------------
+# Broadcast engine
+# -----------------------------
+# A job walks the reachable users of its segment in user_id order (users that
+# answered Forbidden are marked unreachable and skipped), BROADCAST_CHUNK at a
+# time, sending up to BROADCAST_CONCURRENCY messages at once (the outbound
+# limiter keeps the pace). After each chunk the outcomes and the cursor are
+# committed together, so a job interrupted by a crash or restart resumes from
+# its last chunk (at most one chunk is sent twice). A job that fails on
+# something other than a send (database error, bug) is logged, reported in its
+# status message and left running, so the next start resumes it.
+_running: dict[int, asyncio.Task] = {}
+
+
+def start_broadcast(bot, job_id: int):
+	if job_id in _running:
+		return
+	task = asyncio.create_task(_run_guarded(bot, job_id))
+	_running[job_id] = task
+	task.add_done_callback(lambda t: _running.pop(job_id, None))
+
+
+async def resume_broadcasts(bot):
+	"""Restart the jobs that were still running when the bot stopped."""
+	for job_id in await list_running_broadcasts():
+		start_broadcast(bot, job_id)
+
+
+async def stop_broadcasts():
+	tasks = list(_running.values())
+	for task in tasks:
+		task.cancel()
+	for task in tasks:
+		try:
+			await task
+		except asyncio.CancelledError:
+			pass
+
+
+async def _send_one(bot, job: dict, user_id: int, sem: asyncio.Semaphore) -> str:
+	async with sem:
+		while True:
+			try:
+				if job["from_chat_id"]:
+					await bot.copy_message(
+						chat_id=user_id,
+						from_chat_id=job["from_chat_id"],
+						message_id=job["message_id"],
+						rate_limit_args=PRIORITY_BULK,
+					)
+				else:
+					await bot.send_message(
+						chat_id=user_id,
+						text=job["text"],
+						parse_mode=ParseMode.MARKDOWN,
+						rate_limit_args=PRIORITY_BULK,
+					)
+				return "ok"
+			except RetryAfter as e:
+				# The limiter already retried; flood control is not a failure, keep waiting
+				delay = e.retry_after
+				await asyncio.sleep(delay.total_seconds() if isinstance(delay, timedelta) else delay)
+			except Forbidden:
+				return "blocked"  # blocked the bot, deactivated, ...
+			except TelegramError:
+				return "failed"
+
+
+def _fmt_eta(seconds: float) -> str:
+	seconds = int(seconds)
+	if seconds >= 3600:
+		return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+	if seconds >= 60:
+		return f"{seconds // 60}m {seconds % 60:02d}s"
+	return f"{seconds}s"
+
+
+def _progress_text(job: dict, rate: float) -> str:
+	done = job["success"] + job["blocked"] + job["failed"]
+	total = max(job["total"], done)
+	pct = done * 100 // total if total else 100
+	eta = _fmt_eta((total - done) / rate) if rate > 0 else "—"
+	return (
+		f"📤 *Broadcasting…*\n\n"
+		f"👥 Progress: {done}/{total} ({pct}%)\n"
+		f"✅ Success: {job['success']}\n"
+		f"🚫 Blocked: {job['blocked']}\n"
+		f"❌ Failed: {job['failed']}\n"
+		f"⚡ {rate:.1f} msg/s · ⏳ ETA {eta}"
+	)
+
+
+def _failed_text(job: dict, error: Exception) -> str:
+	done = job["success"] + job["blocked"] + job["failed"]
+	return (
+		f"⚠️ *Broadcast interrupted*\n\n"
+		f"👥 Progress: {done}/{max(job['total'], done)}\n"
+		f"❌ Error: `{error}`\n\n"
+		f"It resumes from here on the next restart."
+	)
+
+
+def _report_text(job: dict) -> str:
+	return (
+		f"✅ *Broadcast Complete*\n\n"
+		f"👥 Total: {job['success'] + job['blocked'] + job['failed']}\n"
+		f"✅ Success: {job['success']}\n"
+		f"🚫 Blocked: {job['blocked']}\n"
+		f"❌ Failed: {job['failed']}"
+	)
+
+
+async def _edit_status(bot, job: dict, text: str):
+	if not job["status_message_id"]:
+		return
+	try:
+		await bot.edit_message_text(
+			chat_id=job["admin_chat_id"],
+			message_id=job["status_message_id"],
+			text=text,
+			parse_mode=ParseMode.MARKDOWN,
+		)
+	except TelegramError as e:
+		print(f"broadcast {job['id']} status edit failed: {e}")
+
+
+async def _run_guarded(bot, job_id: int):
+	job = None
+	try:
+		job = await get_broadcast_job(job_id)
+		if not job or job["state"] != "running":
+			return
+		await _run(bot, job)
+	except Exception as e:
+		print(f"broadcast {job_id} failed: {e!r}")
+		if job:
+			await _edit_status(bot, job, _failed_text(job, e))
+
+
+async def _run(bot, job: dict):
+	job_id = job["id"]
+	sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+	started = time.monotonic()
+	last_status = started
+	sent = 0  # this run only, for the throughput figure
+	async for ids in iter_user_id_chunks(BROADCAST_CHUNK, job["segment"], after_id=job["cursor"]):
+		outcomes = await asyncio.gather(*(_send_one(bot, job, uid, sem) for uid in ids))
+		await record_broadcast_chunk(job_id, ids[-1], list(zip(ids, outcomes)))
+		job["cursor"] = ids[-1]
+		job["success"] += outcomes.count("ok")
+		job["blocked"] += outcomes.count("blocked")
+		job["failed"] += outcomes.count("failed")
+		sent += len(ids)
+
+		now = time.monotonic()
+		if now - last_status >= BROADCAST_STATUS_INTERVAL:
+			last_status = now
+			await _edit_status(bot, job, _progress_text(job, sent / (now - started)))
+
+	await finish_broadcast_job(job_id)
+	await _edit_status(bot, job, _report_text(job))
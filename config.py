@@ -1,9 +1,15 @@
-import os, re, json, time
+import os, re, json, time, asyncio
+import pathlib
+import sys
 import aiosqlite
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from typing import Optional, List, Tuple
 from datetime import datetime, timedelta
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ChatMemberStatus
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
 from dotenv import load_dotenv
 
 # Auto-load variables from a .env file if present
@@ -17,23 +23,131 @@ DB_PATH = os.environ.get("SQLITE_PATH", "autocaption.db")
 ADMIN_IDS = os.environ.get("ADMIN_IDS", "")  # "123,456"
 HELP_URL = os.environ.get("HELP_URL", "")  # Optional Telegraph/Docs URL
 
+# SQLite tuning: WAL lets the read-only pool run next to the single writer
+SQLITE_READERS = int(os.environ.get("SQLITE_READERS", "4"))
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+SQLITE_CACHE_KB = int(os.environ.get("SQLITE_CACHE_KB", "16384"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# Seconds between flushes of in-memory counters to the settings table
+STATS_FLUSH_INTERVAL = float(os.environ.get("STATS_FLUSH_INTERVAL", "5"))
+
+# Seconds between bulk writes of users' last_activity
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get("ACTIVITY_FLUSH_INTERVAL", "30"))
+
+# Width of the per-bucket activity rollup used by get_user_stats (seconds)
+ACTIVITY_BUCKET_SECONDS = 300
+ACTIVITY_ROLLUP_WINDOW = 7 * 24 * 3600  # buckets older than this are dropped
+
+# Max get_chat_member calls in flight at once (across all users)
+FORCE_CHECK_CONCURRENCY = int(os.environ.get("FORCE_CHECK_CONCURRENCY", "8"))
+
+# Force-join result cache: per (user, channel), LRU-bounded, separate TTLs for
+# "member" and "not a member" (seconds). chat_member updates from the forced
+# channels keep entries current, so the TTLs are only a safety net.
+FORCE_JOIN_CACHE_MAX = int(os.environ.get("FORCE_JOIN_CACHE_MAX", "50000"))
+FORCE_JOIN_POSITIVE_TTL = float(os.environ.get("FORCE_JOIN_POSITIVE_TTL", str(6 * 3600)))
+FORCE_JOIN_NEGATIVE_TTL = float(os.environ.get("FORCE_JOIN_NEGATIVE_TTL", "600"))
+
+# Documents up to this size are re-uploaded from RAM; larger ones are streamed through a temp file
+TRANSFER_SPOOL_MAX = int(os.environ.get("TRANSFER_SPOOL_MAX", str(32 * 1024 * 1024)))
+
+# Updates processed at once (each user's updates still run one at a time)
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "256"))
+
+# Seconds to wait for more items of an album (media_group_id) before sending it back
+ALBUM_WINDOW = float(os.environ.get("ALBUM_WINDOW", "1.5"))
+
+# Per-chat status message for bursts of files: edited at most every
+# ACK_EDIT_INTERVAL seconds, replaced by a new one after ACK_QUIET idle seconds
+ACK_EDIT_INTERVAL = float(os.environ.get("ACK_EDIT_INTERVAL", "5"))
+ACK_QUIET = float(os.environ.get("ACK_QUIET", "30"))
+
+# Outbound Bot API calls: global messages per second, seconds between messages
+# to one private chat / one group, and retries after a RetryAfter
+OUTBOUND_RATE = float(os.environ.get("OUTBOUND_RATE", "30"))
+OUTBOUND_CHAT_INTERVAL = float(os.environ.get("OUTBOUND_CHAT_INTERVAL", "1"))
+OUTBOUND_GROUP_INTERVAL = float(os.environ.get("OUTBOUND_GROUP_INTERVAL", "3"))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))
+
+# Broadcast: recipients fetched/persisted per chunk, concurrent sends, and
+# seconds between progress edits of the admin's status message
+BROADCAST_CHUNK = int(os.environ.get("BROADCAST_CHUNK", "200"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "30"))
+BROADCAST_STATUS_INTERVAL = float(os.environ.get("BROADCAST_STATUS_INTERVAL", "10"))
+
+# Transfer workers: concurrent sends overall, bytes being transferred at once,
+# and sends in progress per user (1 keeps each user's files in order)
+TRANSFER_WORKERS = int(os.environ.get("TRANSFER_WORKERS", "4"))
+TRANSFER_MAX_BYTES = int(os.environ.get("TRANSFER_MAX_BYTES", str(512 * 1024 * 1024)))
+TRANSFER_PER_USER = int(os.environ.get("TRANSFER_PER_USER", "1"))
+# Seconds queued and running sends get to finish when the bot stops
+TRANSFER_DRAIN_TIMEOUT = float(os.environ.get("TRANSFER_DRAIN_TIMEOUT", "60"))
+
+# Max rows kept in the (file_unique_id, final name) -> file_id cache (LRU)
+FILE_ID_CACHE_MAX = int(os.environ.get("FILE_ID_CACHE_MAX", "20000"))
+
+# Memory budget for the per-user context cache (approximate bytes)
+USER_CACHE_MAX_BYTES = int(os.environ.get("USER_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+
 DEFAULT_TEMPLATE = "{series} Episode {ep}  {version}  {lang}"
 START_TIME = time.time()
 
 # -----------------------------
 # Global connection & cache
 # -----------------------------
-_db: aiosqlite.Connection | None = None
-
-# Force-join cache: {user_id: (is_joined: bool, timestamp: float)}
-# Cache expires after 5 minutes
-_force_join_cache: dict[int, tuple[bool, float]] = {}
-FORCE_JOIN_CACHE_TTL = 300  # 5 minutes in seconds
+_db: aiosqlite.Connection | None = None  # single writer
+_read_pool: asyncio.Queue | None = None    # read-only connections (WAL)
+_readers: list[aiosqlite.Connection] = []
+_background_tasks: list[asyncio.Task] = []  # periodic flushers, stopped by close_db()
+
+# Unit of work: one commit per transaction() scope instead of one per helper.
+# The lock keeps concurrent scopes from interleaving statements on the shared
+# connection; the context var lets nested helpers join the enclosing scope.
+_write_lock = asyncio.Lock()
+_in_transaction: ContextVar[bool] = ContextVar("_in_transaction", default=False)
+# Users whose cached context was touched inside the current scope (dropped on rollback)
+_tx_touched: ContextVar[set | None] = ContextVar("_tx_touched", default=None)
+
+# Per-user context cache: {user_id: {"template", "prefs", "active", "multi", "captions": {cid: row}}}
+# Kept in LRU order and bounded by USER_CACHE_MAX_BYTES; setters write through.
+_user_ctx: "OrderedDict[int, dict]" = OrderedDict()
+_user_ctx_sizes: dict[int, int] = {}
+_user_ctx_bytes = 0
+_user_ctx_hits = 0
+_user_ctx_misses = 0
+
+# Force-join configuration held in memory; writers bump the version to invalidate
+_force_cfg_version = 0
+_force_cfg_cache: tuple[int, dict] | None = None  # (version it was loaded at, config)
+
+# Force-join cache: {(user_id, chat_id): (is_member: bool, expires_at: float)}
+# LRU order, bounded by FORCE_JOIN_CACHE_MAX; snapshotted to SQLite by close_db()
+_force_join_cache: "OrderedDict[tuple[int, int], tuple[bool, float]]" = OrderedDict()
+
+# Membership checks: bounded fan-out, one in-flight check per user (single-flight)
+_member_check_sem = asyncio.Semaphore(FORCE_CHECK_CONCURRENCY)
+_join_inflight: dict[int, asyncio.Task] = {}
+_force_channel_errors: set[int] = set()  # forced channels already reported as uncheckable
+
+async def _apply_pragmas(conn: aiosqlite.Connection, read_only: bool = False):
+    await conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    await conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_KB}")
+    await conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    await conn.execute("PRAGMA temp_store = MEMORY")
+    if read_only:
+        await conn.execute("PRAGMA query_only = ON")
+    else:
+        await conn.execute("PRAGMA journal_mode = WAL")
+        await conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+        await conn.execute("PRAGMA foreign_keys = ON")
 
 async def init_db():
-    global _db
+    global _db, _read_pool
     _db = await aiosqlite.connect(DB_PATH)
     _db.row_factory = aiosqlite.Row
+    await _apply_pragmas(_db)
 
     # Tables
     await _db.executescript(
@@ -42,7 +156,10 @@ async def init_db():
             user_id     INTEGER PRIMARY KEY,
             template    TEXT DEFAULT '{template}',
             joined_date TEXT,
-            last_activity TEXT
+            last_activity TEXT,
+            last_seen   INTEGER,  -- epoch seconds (last_activity is the legacy ISO text)
+            reachable   INTEGER NOT NULL DEFAULT 1,  -- 0 once a broadcast got Forbidden
+            unreachable_since INTEGER
         );
 
         CREATE TABLE IF NOT EXISTS state (
@@ -63,6 +180,8 @@ async def init_db():
             zero_pad     INTEGER NOT NULL DEFAULT 0,
             UNIQUE(user_id, name_norm, version_norm, lang_norm)
         );
+        -- Keyset pagination order: (name_norm, id) within a user (id is the implicit rowid suffix)
+        CREATE INDEX IF NOT EXISTS idx_captions_user_name ON captions(user_id, name_norm);
 
         -- settings(key,value) for flags and counters
         CREATE TABLE IF NOT EXISTS settings (
@@ -84,21 +203,249 @@ async def init_db():
             position   TEXT DEFAULT 'end'
         );
 
-        -- Multi-caption state (selection & pointer)
+        -- Multi-caption state (enabled flag & rotation pointer)
         CREATE TABLE IF NOT EXISTS user_multi (
             user_id   INTEGER PRIMARY KEY,
             enabled   INTEGER NOT NULL DEFAULT 0,
-            ids_json  TEXT NOT NULL DEFAULT '[]',
+            ids_json  TEXT NOT NULL DEFAULT '[]',  -- legacy, see user_multi_items
             pointer   INTEGER NOT NULL DEFAULT 0
         );
+
+        -- Multi-caption selection, one row per caption in rotation order
+        CREATE TABLE IF NOT EXISTS user_multi_items (
+            user_id    INTEGER NOT NULL,
+            ordinal    INTEGER NOT NULL,
+            caption_id INTEGER NOT NULL REFERENCES captions(id) ON DELETE CASCADE,
+            PRIMARY KEY (user_id, ordinal),
+            UNIQUE (user_id, caption_id)
+        );
+
+        -- Activity rollup: number of users whose last_seen falls in each bucket
+        CREATE TABLE IF NOT EXISTS activity_buckets (
+            bucket INTEGER PRIMARY KEY,  -- last_seen // ACTIVITY_BUCKET_SECONDS
+            users  INTEGER NOT NULL DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS force_join_cache (
+            user_id    INTEGER NOT NULL,
+            chat_id    INTEGER NOT NULL,
+            is_member  INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (user_id, chat_id)
+        );
+
+        -- file_id Telegram returned for a document re-uploaded under final_name
+        CREATE TABLE IF NOT EXISTS file_id_cache (
+            file_unique_id TEXT NOT NULL,
+            final_name     TEXT NOT NULL,
+            file_id        TEXT NOT NULL,
+            last_used      INTEGER NOT NULL,
+            PRIMARY KEY (file_unique_id, final_name)
+        );
+        CREATE INDEX IF NOT EXISTS idx_file_id_cache_last_used ON file_id_cache(last_used);
+
+        -- Broadcast jobs walk users in user_id order; cursor = last user_id done
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id                INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_chat_id     INTEGER NOT NULL,
+            status_message_id INTEGER,
+            from_chat_id      INTEGER,  -- copy_message source, or NULL for a text broadcast
+            message_id        INTEGER,
+            text              TEXT,
+            segment           TEXT,     -- see parse_segment(); NULL = all reachable users
+            state             TEXT NOT NULL DEFAULT 'running',  -- running|done
+            cursor            INTEGER NOT NULL DEFAULT 0,
+            total             INTEGER NOT NULL DEFAULT 0,
+            success           INTEGER NOT NULL DEFAULT 0,
+            blocked           INTEGER NOT NULL DEFAULT 0,
+            failed            INTEGER NOT NULL DEFAULT 0,
+            created_at        REAL NOT NULL,
+            finished_at       REAL
+        );
+
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id  INTEGER NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            outcome TEXT NOT NULL,  -- ok|blocked|failed
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID;
         """.replace("{template}", DEFAULT_TEMPLATE.replace("'", "''"))
     )
 
+    async with transaction():
+        await _migrate_schema()
+
     # Default values
-    await _set_setting_default("force_enabled", "0")  # 0=OFF, 1=ON
-    await _set_setting_default("stats_files", "0")
-    await _set_setting_default("stats_storage_bytes", "0")
-    await _db.commit()
+    async with transaction():
+        await _set_setting_default("force_enabled", "0")  # 0=OFF, 1=ON
+        await _set_setting_default("stats_files", "0")
+        await _set_setting_default("stats_storage_bytes", "0")
+
+    # Reader pool (needs a file-backed database; in-memory falls back to the writer)
+    _read_pool = None
+    if SQLITE_READERS > 0 and DB_PATH != ":memory:":
+        _read_pool = asyncio.Queue()
+        uri = pathlib.Path(DB_PATH).absolute().as_uri() + "?mode=ro"
+        for _ in range(SQLITE_READERS):
+            conn = await aiosqlite.connect(uri, uri=True)
+            conn.row_factory = aiosqlite.Row
+            await _apply_pragmas(conn, read_only=True)
+            _readers.append(conn)
+            _read_pool.put_nowait(conn)
+
+    await _load_counters()
+    await _load_force_join_cache()
+    await _load_file_id_count()
+    _start_periodic(STATS_FLUSH_INTERVAL, flush_counters)
+    _start_periodic(ACTIVITY_FLUSH_INTERVAL, flush_activity)
+    _start_periodic(STATS_FLUSH_INTERVAL, flush_file_id_usage)
+
+async def _ensure_column(table: str, column: str, decl: str) -> bool:
+    """Add a column to an existing table; True if it was missing."""
+    cur = await _db.execute(f"PRAGMA table_info({table})")
+    if column in [row["name"] for row in await cur.fetchall()]:
+        return False
+    await _db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+async def _migrate_schema():
+    """In-place upgrades for databases created by older versions."""
+    # users.last_seen: integer epoch copy of the legacy ISO last_activity text
+    await _ensure_column("users", "last_activity", "TEXT")
+    await _ensure_column("users", "last_seen", "INTEGER")
+    await _db.execute(
+        "UPDATE users SET last_seen = CAST(strftime('%s', COALESCE(last_activity, joined_date), 'utc') AS INTEGER) "
+        "WHERE last_seen IS NULL AND COALESCE(last_activity, joined_date) IS NOT NULL"
+    )
+    await _db.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen)")
+
+    # Broadcast suppression: unreachable users are skipped; segments only
+    # ever look at reachable users, hence the partial indexes
+    await _ensure_column("users", "reachable", "INTEGER NOT NULL DEFAULT 1")
+    await _ensure_column("users", "unreachable_since", "INTEGER")
+    await _db.execute("CREATE INDEX IF NOT EXISTS idx_users_reachable ON users(user_id) WHERE reachable = 1")
+    await _db.execute("CREATE INDEX IF NOT EXISTS idx_users_reachable_seen ON users(last_seen) WHERE reachable = 1")
+    await _db.execute("CREATE INDEX IF NOT EXISTS idx_users_reachable_joined ON users(joined_date) WHERE reachable = 1")
+    await _ensure_column("broadcast_jobs", "segment", "TEXT")
+    # Outcomes of finished jobs are dropped by finish_broadcast_job; clear older leftovers
+    await _db.execute(
+        "DELETE FROM broadcast_recipients WHERE job_id IN (SELECT id FROM broadcast_jobs WHERE state != 'running')"
+    )
+
+    # Activity rollup, built once from the users table then maintained by flush_activity()
+    cur = await _db.execute("SELECT value FROM settings WHERE key = 'activity_rollup'")
+    if not await cur.fetchone():
+        await _db.execute("DELETE FROM activity_buckets")
+        await _db.execute(
+            "INSERT INTO activity_buckets(bucket, users) "
+            "SELECT last_seen / ?, COUNT(*) FROM users WHERE last_seen >= ? GROUP BY 1",
+            (ACTIVITY_BUCKET_SECONDS, int(time.time()) - ACTIVITY_ROLLUP_WINDOW)
+        )
+        await _set_setting("activity_rollup", "1")
+
+    # Multi-caption selections move from user_multi.ids_json to user_multi_items
+    cur = await _db.execute("SELECT value FROM settings WHERE key = 'multi_items'")
+    if not await cur.fetchone():
+        await _db.execute(
+            "INSERT OR IGNORE INTO user_multi_items(user_id, ordinal, caption_id) "
+            "SELECT m.user_id, j.key, c.id FROM user_multi m, json_each(m.ids_json) j "
+            "JOIN captions c ON c.id = j.value AND c.user_id = m.user_id"
+        )
+        await _db.execute("UPDATE user_multi SET ids_json = '[]'")
+        await _set_setting("multi_items", "1")
+
+    # Total users counter (kept up to date by flush_activity / set_user)
+    cur = await _db.execute("SELECT value FROM settings WHERE key = 'stats_users'")
+    if not await cur.fetchone():
+        await _db.execute("INSERT INTO settings(key, value) SELECT 'stats_users', COUNT(*) FROM users")
+
+def _start_periodic(interval: float, fn):
+    """Run `fn` every `interval` seconds until close_db()."""
+    async def loop():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await fn()
+            except Exception as e:
+                print(f"{fn.__name__} failed: {e}")
+    _background_tasks.append(asyncio.get_running_loop().create_task(loop()))
+
+async def close_db():
+    """Stop the flushers, persist what they hold, then close every connection."""
+    global _db, _read_pool
+    while _background_tasks:
+        task = _background_tasks.pop()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    if _db is not None:
+        await flush_counters()
+        await flush_activity()
+        await flush_file_id_usage()
+        await _save_force_join_cache()
+    _read_pool = None
+    while _readers:
+        await _readers.pop().close()
+    if _db is not None:
+        await _db.close()
+        _db = None
+
+@asynccontextmanager
+async def _reader():
+    """
+    Borrow a read-only connection from the pool.
+    Inside a transaction() scope the writer is used instead, so a unit of
+    work always sees its own uncommitted writes.
+    """
+    pool = _read_pool
+    if pool is None or _in_transaction.get():
+        yield _db
+        return
+    conn = await pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put_nowait(conn)
+
+async def _fetchone(sql: str, params: tuple = ()):
+    async with _reader() as db:
+        async with db.execute(sql, params) as cur:
+            return await cur.fetchone()
+
+async def _fetchall(sql: str, params: tuple = ()) -> list:
+    async with _reader() as db:
+        async with db.execute(sql, params) as cur:
+            return await cur.fetchall()
+
+@asynccontextmanager
+async def transaction():
+    """
+    Group every write made inside the block into a single commit.
+
+    Nested scopes (including the write helpers below, which all open one)
+    join the outermost scope, so a handler can wrap several helpers and pay
+    for one fsync. Any exception rolls the whole unit back and is re-raised.
+    """
+    if _in_transaction.get():
+        yield _db
+        return
+    async with _write_lock:
+        token = _in_transaction.set(True)
+        touched_token = _tx_touched.set(set())
+        try:
+            yield _db
+        except BaseException:
+            await _db.rollback()
+            for uid in _tx_touched.get():
+                clear_user_cache(uid)
+            raise
+        else:
+            await _db.commit()
+        finally:
+            _tx_touched.reset(touched_token)
+            _in_transaction.reset(token)
 
 async def _set_setting_default(key: str, default_val: str):
     cur = await _db.execute("SELECT value FROM settings WHERE key = ?", (key,))
@@ -120,38 +467,49 @@ def get_admin_ids() -> set[int]:
 def is_admin(user_id: int) -> bool:
     return user_id in get_admin_ids()
 
+def bump_force_config_version():
+    """Invalidate the in-memory force-join config (after any change to it)."""
+    global _force_cfg_version
+    _force_cfg_version += 1
+
 async def get_force_config() -> dict:
-    enabled = await _get_setting_int("force_enabled", 0)
-    cur = await _db.execute("SELECT chat_id, username, title, invite_link FROM force_channels")
-    channels = [dict(row) for row in await cur.fetchall()]
-    return {"enabled": bool(enabled), "channels": channels}
+    global _force_cfg_cache
+    cached = _force_cfg_cache
+    if cached is None or cached[0] != _force_cfg_version:
+        version = _force_cfg_version
+        enabled = await _get_setting_int("force_enabled", 0)
+        rows = await _fetchall("SELECT chat_id, username, title, invite_link FROM force_channels")
+        cached = (version, {"enabled": bool(enabled), "channels": [dict(row) for row in rows]})
+        _force_cfg_cache = cached
+    # Callers may mutate the result (admin toggles), so hand out a copy
+    force = cached[1]
+    return {"enabled": force["enabled"], "channels": [dict(ch) for ch in force["channels"]]}
 
 async def set_force_config(force: dict):
     # Toggle ON/OFF only here
-    await _set_setting("force_enabled", "1" if force.get("enabled") else "0")
+    async with transaction():
+        await _set_setting("force_enabled", "1" if force.get("enabled") else "0")
+    bump_force_config_version()
     # The channel list is maintained by add/remove
-    await _db.commit()
 
 async def add_force_channel(chat_id: int, username: str = None, title: str = None, invite_link: str = None):
     try:
-        await _db.execute(
-            "INSERT OR IGNORE INTO force_channels(chat_id, username, title, invite_link) VALUES(?,?,?,?)",
-            (chat_id, username, title or str(chat_id), invite_link)
-        )
-        await _db.commit()
-        # True if newly added (INSERT OR IGNORE cannot easily distinguish)
-        cur = await _db.execute("SELECT changes() AS ch")
-        ch = (await cur.fetchone())["ch"]
-        return ch > 0
+        async with transaction():
+            cur = await _db.execute(
+                "INSERT OR IGNORE INTO force_channels(chat_id, username, title, invite_link) VALUES(?,?,?,?)",
+                (chat_id, username, title or str(chat_id), invite_link)
+            )
+        bump_force_config_version()
+        # True if newly added (ignored duplicates report no changed rows)
+        return cur.rowcount > 0
     except:
         return False
 
 async def remove_force_channel(chat_id: int):
-    await _db.execute("DELETE FROM force_channels WHERE chat_id = ?", (chat_id,))
-    await _db.commit()
-    cur = await _db.execute("SELECT changes() AS ch")
-    ch = (await cur.fetchone())["ch"]
-    return ch > 0
+    async with transaction():
+        cur = await _db.execute("DELETE FROM force_channels WHERE chat_id = ?", (chat_id,))
+    bump_force_config_version()
+    return cur.rowcount > 0
 
 async def check_user_joined(bot, user_id: int, use_cache: bool = True) -> Tuple[bool, list]:
     """
@@ -165,50 +523,148 @@ async def check_user_joined(bot, user_id: int, use_cache: bool = True) -> Tuple[
     Returns:
         Tuple of (is_joined: bool, missing_channels: list)
     """
-    global _force_join_cache
-
+    if is_admin(user_id):
+        return True, []
+    # In-memory config: no database round trip while force-join is OFF
     force = await get_force_config()
     if not force.get("enabled"):
         return True, []
-    if is_admin(user_id):
-        return True, []
 
-    # Check cache first
-    if use_cache and user_id in _force_join_cache:
-        is_joined, timestamp = _force_join_cache[user_id]
-        if time.time() - timestamp < FORCE_JOIN_CACHE_TTL:
-            # Cache is still valid
-            if is_joined:
-                return True, []
-            # If cached as not joined, we still recheck (user might have joined)
-
-    # Perform actual check
-    missing = []
-    for ch in force.get("channels", []):
-        cid = ch.get("chat_id")
-        if not cid:
-            continue
+    channels = [ch for ch in force.get("channels", []) if ch.get("chat_id")]
+    status: dict[int, Optional[bool]] = {}
+    if use_cache:
+        now = time.time()
+        for ch in channels:
+            hit = _join_cache_get(user_id, ch["chat_id"], now)
+            if hit is not None:
+                status[ch["chat_id"]] = hit
+
+    pending = [ch for ch in channels if ch["chat_id"] not in status]
+    if pending:
+        # Single-flight: concurrent handlers for the same user share one check.
+        # A forced recheck starts a fresh one that later callers then join.
+        task = _join_inflight.get(user_id) if use_cache else None
+        if task is None:
+            task = asyncio.create_task(_check_channels(bot, user_id, pending))
+            _join_inflight[user_id] = task
+            task.add_done_callback(lambda t, uid=user_id: _forget_inflight(uid, t))
+        # shield: a cancelled handler must not cancel the check others are awaiting
+        status.update(await asyncio.shield(task))
+        # The shared check may have covered a different set of channels
+        rest = [ch for ch in pending if ch["chat_id"] not in status]
+        if rest:
+            status.update(await _check_channels(bot, user_id, rest))
+
+    # Unknown (the call failed) counts as missing for now but was not cached
+    missing = [ch for ch in channels if not status[ch["chat_id"]]]
+    return not missing, missing
+
+def _forget_inflight(user_id: int, task: asyncio.Task):
+    if _join_inflight.get(user_id) is task:
+        del _join_inflight[user_id]
+
+async def _is_channel_member(bot, chat_id: int, user_id: int) -> Optional[bool]:
+    """
+    Membership of user_id in chat_id. Telegram refusing the lookup (user not
+    found, bot not admin there, ...) counts as not a member; None means the
+    call itself failed (timeout, network, flood control) and nothing is known.
+    """
+    async with _member_check_sem:
         try:
-            member = await bot.get_chat_member(cid, user_id)
-            if member.status not in (ChatMemberStatus.OWNER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.MEMBER):
-                missing.append(ch)
-        except Exception:
-            missing.append(ch)
-
-    # Update cache
-    is_joined = len(missing) == 0
-    _force_join_cache[user_id] = (is_joined, time.time())
+            member = await bot.get_chat_member(chat_id, user_id)
+        except BadRequest as e:  # before NetworkError, its base class
+            if "user not found" not in str(e).lower():
+                _report_force_channel(chat_id, e)
+            return False
+        except (NetworkError, RetryAfter):
+            return None
+        except TelegramError as e:  # Forbidden: bot removed from the channel, ...
+            _report_force_channel(chat_id, e)
+            return False
+    return _is_member_status(member.status)
+
+def _report_force_channel(chat_id: int, error: Exception):
+    """Log a forced channel the bot cannot check, once per run."""
+    if chat_id not in _force_channel_errors:
+        _force_channel_errors.add(chat_id)
+        print(f"force-join: cannot check members of {chat_id} (is the bot admin there?): {error}")
+
+def _is_member_status(status) -> bool:
+    return status in (ChatMemberStatus.OWNER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.MEMBER)
+
+async def record_chat_member(chat_id: int, user_id: int, status) -> bool:
+    """Apply a chat_member update to the cache. Returns False if chat_id isn't a forced channel."""
+    force = await get_force_config()
+    if not any(ch.get("chat_id") == chat_id for ch in force.get("channels", [])):
+        return False
+    _join_cache_put(user_id, chat_id, _is_member_status(status))
+    return True
 
-    return is_joined, missing
+async def _check_channels(bot, user_id: int, channels: list) -> dict[int, Optional[bool]]:
+    """
+    Check the given channels concurrently; returns {chat_id: is_member}.
+    Real answers are cached; failed checks (None) are not, so the next call retries.
+    """
+    results = await asyncio.gather(*(_is_channel_member(bot, ch["chat_id"], user_id) for ch in channels))
+    status = {}
+    for ch, ok in zip(channels, results):
+        status[ch["chat_id"]] = ok
+        if ok is not None:
+            _join_cache_put(user_id, ch["chat_id"], ok)
+    return status
+
+def _join_cache_get(user_id: int, chat_id: int, now: Optional[float] = None) -> Optional[bool]:
+    """Cached membership, or None when unknown/expired."""
+    key = (user_id, chat_id)
+    hit = _force_join_cache.get(key)
+    if hit is None:
+        return None
+    if hit[1] <= (now if now is not None else time.time()):
+        del _force_join_cache[key]
+        return None
+    _force_join_cache.move_to_end(key)
+    return hit[0]
+
+def _join_cache_put(user_id: int, chat_id: int, is_member: bool, ttl: Optional[float] = None):
+    if ttl is None:
+        ttl = FORCE_JOIN_POSITIVE_TTL if is_member else FORCE_JOIN_NEGATIVE_TTL
+    key = (user_id, chat_id)
+    _force_join_cache[key] = (is_member, time.time() + ttl)
+    _force_join_cache.move_to_end(key)
+    while len(_force_join_cache) > FORCE_JOIN_CACHE_MAX:
+        _force_join_cache.popitem(last=False)
 
 def clear_force_join_cache(user_id: Optional[int] = None):
     """Clear force-join cache for a specific user or all users"""
-    global _force_join_cache
     if user_id is not None:
-        _force_join_cache.pop(user_id, None)
+        for key in [k for k in _force_join_cache if k[0] == user_id]:
+            del _force_join_cache[key]
     else:
         _force_join_cache.clear()
 
+async def _load_force_join_cache():
+    """Warm restart: reload the entries that have not expired yet."""
+    _force_join_cache.clear()
+    rows = await _fetchall(
+        "SELECT user_id, chat_id, is_member, expires_at FROM force_join_cache "
+        "WHERE expires_at > ? ORDER BY expires_at DESC LIMIT ?",
+        (time.time(), FORCE_JOIN_CACHE_MAX)
+    )
+    # Soonest-to-expire first, so they are the first evicted
+    for row in reversed(rows):
+        _force_join_cache[(row["user_id"], row["chat_id"])] = (bool(row["is_member"]), row["expires_at"])
+
+async def _save_force_join_cache():
+    now = time.time()
+    rows = [(uid, cid, int(ok), exp) for (uid, cid), (ok, exp) in _force_join_cache.items() if exp > now]
+    async with transaction():
+        await _db.execute("DELETE FROM force_join_cache")
+        if rows:
+            await _db.executemany(
+                "INSERT INTO force_join_cache(user_id, chat_id, is_member, expires_at) VALUES(?,?,?,?)",
+                rows
+            )
+
 def build_join_buttons(force_cfg: dict) -> InlineKeyboardMarkup:
     btns = []
     for ch in force_cfg.get("channels", []):
@@ -226,89 +682,300 @@ def build_join_buttons(force_cfg: dict) -> InlineKeyboardMarkup:
 # -----------------------------
 # Stats
 # -----------------------------
+# Counters live in memory: {settings key: persisted base + pending delta}.
+# Deltas are added to the settings rows every STATS_FLUSH_INTERVAL seconds
+# and at shutdown, so a crash loses at most one interval of increments.
+_counters: dict[str, int] = {}
+_counter_deltas: dict[str, int] = {}
+
+async def _load_counters():
+    rows = await _fetchall("SELECT key, value FROM settings WHERE key LIKE 'stats\\_%' ESCAPE '\\'")
+    for row in rows:
+        try:
+            base = int(row["value"])
+        except (TypeError, ValueError):
+            base = 0
+        _counters[row["key"]] = base + _counter_deltas.get(row["key"], 0)
+
+def incr_counter(key: str, delta: int = 1):
+    """Add `delta` to the counter stored under settings `key` (flushed later)."""
+    delta = int(delta)
+    if not delta:
+        return
+    _counters[key] = _counters.get(key, 0) + delta
+    _counter_deltas[key] = _counter_deltas.get(key, 0) + delta
+
+def get_counter(key: str) -> int:
+    return max(0, _counters.get(key, 0))
+
+async def flush_counters():
+    if not _counter_deltas:
+        return
+    pending = dict(_counter_deltas)
+    _counter_deltas.clear()
+    try:
+        async with transaction():
+            await _db.executemany(
+                "INSERT INTO settings(key,value) VALUES(?,?) "
+                "ON CONFLICT(key) DO UPDATE SET value = CAST(COALESCE(value, 0) AS INTEGER) + CAST(excluded.value AS INTEGER)",
+                [(k, str(v)) for k, v in pending.items()]
+            )
+    except Exception:
+        # Keep the deltas for the next attempt
+        for k, v in pending.items():
+            _counter_deltas[k] = _counter_deltas.get(k, 0) + v
+        raise
+
 async def update_stats(files_delta: int = 0, bytes_delta: int = 0):
-    files = await _get_setting_int("stats_files", 0) + int(files_delta)
-    bytes_ = await _get_setting_int("stats_storage_bytes", 0) + int(bytes_delta)
-    await _set_setting("stats_files", str(max(0, files)))
-    await _set_setting("stats_storage_bytes", str(max(0, bytes_)))
-    await _db.commit()
+    incr_counter("stats_files", files_delta)
+    incr_counter("stats_storage_bytes", bytes_delta)
 
 async def get_stats() -> dict:
-    files = await _get_setting_int("stats_files", 0)
-    bytes_ = await _get_setting_int("stats_storage_bytes", 0)
-    return {"files": files, "storage_bytes": bytes_}
+    return {"files": get_counter("stats_files"), "storage_bytes": get_counter("stats_storage_bytes")}
+
+# How media got sent back: "reuse" (original file_id, name unchanged), "cached"
+# (file_id of an earlier renamed upload), "upload" (download + re-upload) or
+# "copy" (copy_message for non-documents)
+TRANSFER_PATHS = ("reuse", "cached", "upload", "copy")
+
+def record_transfer(path: str, size: int = 0):
+    """Count one send by path; bytes a reuse/cached send avoided moving count as saved."""
+    incr_counter(f"stats_transfer_{path}")
+    if path == "upload":
+        incr_counter("stats_transfer_bytes", size or 0)
+    elif path in ("reuse", "cached"):
+        incr_counter("stats_transfer_saved_bytes", size or 0)
+
+def get_transfer_stats() -> dict:
+    stats = {path: get_counter(f"stats_transfer_{path}") for path in TRANSFER_PATHS}
+    stats["bytes"] = get_counter("stats_transfer_bytes")
+    stats["saved_bytes"] = get_counter("stats_transfer_saved_bytes")
+    return stats
+
+# Activity is debounced: track_user only records the latest timestamp in
+# memory and flush_activity() upserts them in bulk every ACTIVITY_FLUSH_INTERVAL
+# seconds. Users whose stored value is already within that window are skipped.
+_activity_pending: dict[int, float] = {}   # user_id -> latest seen (epoch)
+_activity_flushed: dict[int, float] = {}   # user_id -> last persisted (recent users only)
 
 async def track_user(user_id: int):
-    # upsert
-    now = datetime.now().isoformat(timespec="seconds")
-    cur = await _db.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-    row = await cur.fetchone()
-    if not row:
-        await _db.execute(
-            "INSERT INTO users(user_id, template, joined_date, last_activity) VALUES(?,?,?,?)",
-            (user_id, DEFAULT_TEMPLATE, now, now)
+    _activity_pending[user_id] = time.time()
+
+async def flush_activity():
+    if not _activity_pending:
+        return
+    pending = dict(_activity_pending)
+    _activity_pending.clear()
+    seen = {uid: int(ts) for uid, ts in pending.items()
+            if ts - _activity_flushed.get(uid, 0) >= ACTIVITY_FLUSH_INTERVAL}
+    new_users = 0
+    try:
+        if seen:
+            async with transaction():
+                new_users = await _write_activity(seen)
+    except Exception:
+        for uid, ts in pending.items():
+            _activity_pending[uid] = max(ts, _activity_pending.get(uid, 0))
+        raise
+    for uid, ts in pending.items():
+        if ts - _activity_flushed.get(uid, 0) >= ACTIVITY_FLUSH_INTERVAL:
+            _activity_flushed[uid] = ts
+    incr_counter("stats_users", new_users)
+    # Only users seen within the window can be skipped next time
+    cutoff = time.time() - ACTIVITY_FLUSH_INTERVAL
+    for uid in [u for u, ts in _activity_flushed.items() if ts < cutoff]:
+        del _activity_flushed[uid]
+
+async def _write_activity(seen: dict[int, int]) -> int:
+    """Persist last_seen values and move users between rollup buckets.
+    Returns the number of users inserted."""
+    ids = list(seen)
+    previous: dict[int, Optional[int]] = {}
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        cur = await _db.execute(
+            f"SELECT user_id, last_seen FROM users WHERE user_id IN ({','.join('?' * len(chunk))})", chunk
         )
-    else:
-        await _db.execute(
-            "UPDATE users SET last_activity = ? WHERE user_id = ?",
-            (now, user_id)
+        for row in await cur.fetchall():
+            previous[row["user_id"]] = row["last_seen"]
+
+    inserts, updates = [], []
+    buckets: dict[int, int] = {}
+    oldest = (int(time.time()) - ACTIVITY_ROLLUP_WINDOW) // ACTIVITY_BUCKET_SECONDS
+    for uid, ts in seen.items():
+        if uid not in previous:
+            joined = datetime.fromtimestamp(ts).isoformat(timespec="seconds")
+            inserts.append((uid, DEFAULT_TEMPLATE, joined, ts))
+        else:
+            old = previous[uid]
+            if old is not None and old >= ts:
+                continue
+            updates.append((ts, uid))
+            if old is not None and old // ACTIVITY_BUCKET_SECONDS >= oldest:
+                b = old // ACTIVITY_BUCKET_SECONDS
+                buckets[b] = buckets.get(b, 0) - 1
+        b = ts // ACTIVITY_BUCKET_SECONDS
+        buckets[b] = buckets.get(b, 0) + 1
+
+    if inserts:
+        await _db.executemany(
+            "INSERT INTO users(user_id, template, joined_date, last_seen) VALUES(?,?,?,?)", inserts
+        )
+    if updates:
+        # Any interaction proves the chat works again
+        await _db.executemany(
+            "UPDATE users SET last_seen = ?, reachable = 1, unreachable_since = NULL WHERE user_id = ?", updates
         )
-    await _db.commit()
+    if buckets:
+        await _db.executemany(
+            "INSERT INTO activity_buckets(bucket, users) VALUES(?,?) "
+            "ON CONFLICT(bucket) DO UPDATE SET users = users + excluded.users",
+            [(b, n) for b, n in buckets.items() if n]
+        )
+    await _db.execute("DELETE FROM activity_buckets WHERE bucket < ?", (oldest,))
+    return len(inserts)
 
 async def get_total_users() -> int:
-    cur = await _db.execute("SELECT COUNT(*) AS c FROM users")
-    return (await cur.fetchone())["c"]
+    return get_counter("stats_users")
 
 async def get_user_stats() -> dict:
-    """Get detailed user activity statistics"""
-    from datetime import datetime, timedelta
-
-    now = datetime.now()
-    one_hour_ago = (now - timedelta(hours=1)).isoformat(timespec="seconds")
-    one_day_ago = (now - timedelta(days=1)).isoformat(timespec="seconds")
-    seven_days_ago = (now - timedelta(days=7)).isoformat(timespec="seconds")
-
-    # Total users
-    cur = await _db.execute("SELECT COUNT(*) AS c FROM users")
-    total = (await cur.fetchone())["c"]
-
-    # Active in last hour
-    cur = await _db.execute(
-        "SELECT COUNT(*) AS c FROM users WHERE last_activity >= ?",
-        (one_hour_ago,)
-    )
-    active_1h = (await cur.fetchone())["c"]
-
-    # Active in last 24 hours
-    cur = await _db.execute(
-        "SELECT COUNT(*) AS c FROM users WHERE last_activity >= ?",
-        (one_day_ago,)
+    """Get detailed user activity statistics (constant time, from the rollup)"""
+    now = int(time.time())
+    row = await _fetchone(
+        "SELECT COALESCE(SUM(CASE WHEN bucket >= ? THEN users END), 0) AS h1, "
+        "       COALESCE(SUM(CASE WHEN bucket >= ? THEN users END), 0) AS d1, "
+        "       COALESCE(SUM(users), 0) AS d7 "
+        "FROM activity_buckets WHERE bucket >= ?",
+        ((now - 3600) // ACTIVITY_BUCKET_SECONDS,
+         (now - 86400) // ACTIVITY_BUCKET_SECONDS,
+         (now - ACTIVITY_ROLLUP_WINDOW) // ACTIVITY_BUCKET_SECONDS)
     )
-    active_24h = (await cur.fetchone())["c"]
-
-    # Active in last 7 days
-    cur = await _db.execute(
-        "SELECT COUNT(*) AS c FROM users WHERE last_activity >= ?",
-        (seven_days_ago,)
-    )
-    active_7d = (await cur.fetchone())["c"]
-
-    # Inactive (7+ days)
-    inactive = total - active_7d
+    total = get_counter("stats_users")
+    active_7d = row["d7"]
 
     return {
         "total": total,
-        "active_1h": active_1h,
-        "active_24h": active_24h,
+        "active_1h": row["h1"],
+        "active_24h": row["d1"],
         "active_7d": active_7d,
-        "inactive_7d": inactive
+        "inactive_7d": max(0, total - active_7d)
     }
 
+# Broadcast segments: "active:N" (seen in the last N days) or
+# "joined:YYYY-MM-DD" (joined on/after that date); None means everybody
+_SEGMENT_RE = re.compile(r"^(active):(\d{1,4})$|^(joined):(\d{4}-\d{2}-\d{2})$")
+
+def parse_segment(spec: Optional[str]) -> Optional[str]:
+    """Validate a segment spec; returns it normalized, or raises ValueError."""
+    if not spec:
+        return None
+    spec = spec.strip().lower()
+    m = _SEGMENT_RE.match(spec)
+    if not m:
+        raise ValueError(f"unknown segment: {spec}")
+    if m.group(4):
+        datetime.strptime(m.group(4), "%Y-%m-%d")  # rejects 2024-13-40
+    return spec
+
+def _segment_filter(segment: Optional[str], include_unreachable: bool = False) -> Tuple[str, tuple]:
+    """SQL condition (and params) selecting the segment, among reachable users unless told otherwise."""
+    segment = parse_segment(segment)
+    cond, params = ("1", ()) if include_unreachable else ("reachable = 1", ())
+    if segment is None:
+        return cond, params
+    kind, value = segment.split(":", 1)
+    if kind == "active":
+        return cond + " AND last_seen >= ?", (int(time.time()) - int(value) * 86400,)
+    return cond + " AND joined_date >= ?", (value,)
+
+async def count_broadcast_recipients(segment: Optional[str] = None) -> int:
+    cond, params = _segment_filter(segment)
+    row = await _fetchone(f"SELECT COUNT(*) AS n FROM users WHERE {cond}", params)
+    return row["n"]
+
+async def iter_user_id_chunks(chunk_size: int = 1000, segment: Optional[str] = None, after_id: int = 0,
+                              include_unreachable: bool = False):
+    """
+    Walk users in user_id order with keyset pagination, yielding lists of at
+    most `chunk_size` ids. Only one chunk is held at a time and each page is a
+    separate indexed query, so the first ids are available immediately.
+    Reachable users only unless include_unreachable.
+    """
+    cond, params = _segment_filter(segment, include_unreachable)
+    sql = f"SELECT user_id FROM users WHERE {cond} AND user_id > ? ORDER BY user_id LIMIT ?"
+    while True:
+        rows = await _fetchall(sql, params + (after_id, chunk_size))
+        if not rows:
+            return
+        ids = [row["user_id"] for row in rows]
+        yield ids
+        if len(ids) < chunk_size:
+            return
+        after_id = ids[-1]
+
+async def iter_user_ids(chunk_size: int = 1000, segment: Optional[str] = None, after_id: int = 0,
+                        include_unreachable: bool = False):
+    """iter_user_id_chunks, one id at a time (exports, maintenance jobs)."""
+    async for ids in iter_user_id_chunks(chunk_size, segment, after_id, include_unreachable):
+        for user_id in ids:
+            yield user_id
+
 async def get_all_user_ids() -> List[int]:
-    """Get all user IDs for broadcast"""
-    cur = await _db.execute("SELECT user_id FROM users")
-    rows = await cur.fetchall()
-    return [row["user_id"] for row in rows]
+    """Get all user IDs (materialized; prefer iter_user_ids for large tables)"""
+    return [uid async for uid in iter_user_ids(include_unreachable=True)]
+
+# -----------------------------
+# Broadcast jobs
+# -----------------------------
+async def create_broadcast_job(admin_chat_id: int, status_message_id: Optional[int],
+                               from_chat_id: Optional[int] = None, message_id: Optional[int] = None,
+                               text: Optional[str] = None, segment: Optional[str] = None) -> int:
+    cond, params = _segment_filter(segment)
+    async with transaction():
+        cur = await _db.execute(
+            "INSERT INTO broadcast_jobs(admin_chat_id, status_message_id, from_chat_id, message_id, text, segment, total, created_at) "
+            f"VALUES(?,?,?,?,?,?,(SELECT COUNT(*) FROM users WHERE {cond}),?)",
+            (admin_chat_id, status_message_id, from_chat_id, message_id, text, parse_segment(segment)) + params + (time.time(),)
+        )
+    return cur.lastrowid
+
+async def get_broadcast_job(job_id: int) -> Optional[dict]:
+    row = await _fetchone("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,))
+    return dict(row) if row else None
+
+async def list_running_broadcasts() -> List[int]:
+    rows = await _fetchall("SELECT id FROM broadcast_jobs WHERE state = 'running' ORDER BY id")
+    return [row["id"] for row in rows]
+
+async def record_broadcast_chunk(job_id: int, cursor: int, outcomes: List[Tuple[int, str]]):
+    """Persist one chunk: per-recipient outcomes, counters and the cursor, atomically."""
+    counts = {"ok": 0, "blocked": 0, "failed": 0}
+    for _, outcome in outcomes:
+        counts[outcome] += 1
+    async with transaction():
+        await _db.executemany(
+            "INSERT OR REPLACE INTO broadcast_recipients(job_id, user_id, outcome) VALUES(?,?,?)",
+            [(job_id, uid, outcome) for uid, outcome in outcomes]
+        )
+        await _db.execute(
+            "UPDATE broadcast_jobs SET cursor = ?, success = success + ?, blocked = blocked + ?, failed = failed + ? "
+            "WHERE id = ?",
+            (cursor, counts["ok"], counts["blocked"], counts["failed"], job_id)
+        )
+        # Suppression list: later broadcasts skip these until they interact again
+        now = int(time.time())
+        await _db.executemany(
+            "UPDATE users SET reachable = 0, unreachable_since = ? WHERE user_id = ? AND reachable = 1",
+            [(now, uid) for uid, outcome in outcomes if outcome == "blocked"]
+        )
+
+async def finish_broadcast_job(job_id: int):
+    """Mark a job done; its per-user outcomes were only needed while it ran."""
+    async with transaction():
+        await _db.execute(
+            "UPDATE broadcast_jobs SET state = 'done', finished_at = ? WHERE id = ?", (time.time(), job_id)
+        )
+        await _db.execute("DELETE FROM broadcast_recipients WHERE job_id = ?", (job_id,))
 
 # -----------------------------
 # Utils
@@ -494,36 +1161,156 @@ def normalize_version(raw: Optional[str]) -> str:
     base_clean = re.sub(r"\s+", " ", (raw or "").strip())
     return base_clean
 
+# -----------------------------
+# User context cache
+# -----------------------------
+_MISSING = object()
+
+def _approx_size(obj) -> int:
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_approx_size(k) + _approx_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_approx_size(v) for v in obj)
+    return size
+
+def _ctx_lookup(user_id: int, field: str, key=None):
+    """Return the cached value or _MISSING, counting hits and misses."""
+    global _user_ctx_hits, _user_ctx_misses
+    entry = _user_ctx.get(user_id)
+    val = _MISSING
+    if entry is not None:
+        val = entry.get(field, _MISSING)
+        if key is not None and val is not _MISSING:
+            val = val.get(key, _MISSING)
+    if val is _MISSING:
+        _user_ctx_misses += 1
+    else:
+        _user_ctx_hits += 1
+        _user_ctx.move_to_end(user_id)
+    return val
+
+def _ctx_store(user_id: int, field: str, value, key=None):
+    entry = _user_ctx.get(user_id)
+    if entry is None:
+        entry = _user_ctx[user_id] = {}
+    if key is None:
+        entry[field] = value
+    else:
+        entry.setdefault(field, {})[key] = value
+    _user_ctx.move_to_end(user_id)
+    _ctx_resize(user_id)
+
+def _ctx_drop(user_id: int, field: str, key=None):
+    entry = _user_ctx.get(user_id)
+    if entry is None:
+        return
+    if key is None:
+        entry.pop(field, None)
+    else:
+        entry.get(field, {}).pop(key, None)
+    _ctx_resize(user_id)
+
+def _ctx_patch(user_id: int, field: str, updates: dict, key=None):
+    """Update a cached dict in place if present (write-through)."""
+    entry = _user_ctx.get(user_id)
+    if entry is None:
+        return
+    val = entry.get(field)
+    if key is not None and val is not None:
+        val = val.get(key)
+    if isinstance(val, dict):
+        val.update(updates)
+        _ctx_resize(user_id)
+
+def _ctx_resize(user_id: int):
+    global _user_ctx_bytes
+    touched = _tx_touched.get()
+    if touched is not None:
+        touched.add(user_id)
+    entry = _user_ctx.get(user_id)
+    old = _user_ctx_sizes.pop(user_id, 0)
+    _user_ctx_bytes -= old
+    if entry is None:
+        return
+    size = _approx_size(entry)
+    _user_ctx_sizes[user_id] = size
+    _user_ctx_bytes += size
+    # Evict least recently used users, never the one just touched
+    while _user_ctx_bytes > USER_CACHE_MAX_BYTES and len(_user_ctx) > 1:
+        lru_id, _ = _user_ctx.popitem(last=False)
+        _user_ctx_bytes -= _user_ctx_sizes.pop(lru_id, 0)
+
+def clear_user_cache(user_id: Optional[int] = None):
+    """Drop the cached context of one user, or of everyone"""
+    global _user_ctx_bytes
+    if user_id is None:
+        _user_ctx.clear()
+        _user_ctx_sizes.clear()
+        _user_ctx_bytes = 0
+        return
+    _user_ctx.pop(user_id, None)
+    _user_ctx_bytes -= _user_ctx_sizes.pop(user_id, 0)
+
+def get_user_cache_stats() -> dict:
+    total = _user_ctx_hits + _user_ctx_misses
+    return {
+        "users": len(_user_ctx),
+        "bytes": _user_ctx_bytes,
+        "hits": _user_ctx_hits,
+        "misses": _user_ctx_misses,
+        "hit_rate": (_user_ctx_hits / total) if total else 0.0,
+    }
+
 # -----------------------------
 # User data / captions
 # -----------------------------
 async def get_user(user_id: int) -> dict:
-    cur = await _db.execute("SELECT user_id, template FROM users WHERE user_id = ?", (user_id,))
-    row = await cur.fetchone()
+    template = _ctx_lookup(user_id, "template")
+    if template is not _MISSING:
+        return {"user_id": user_id, "template": template}
+    row = await _fetchone("SELECT user_id, template FROM users WHERE user_id = ?", (user_id,))
     if not row:
         await track_user(user_id)
-        return {"user_id": user_id, "template": DEFAULT_TEMPLATE}
-    return {"user_id": row["user_id"], "template": row["template"] or DEFAULT_TEMPLATE}
+        template = DEFAULT_TEMPLATE
+    else:
+        template = row["template"] or DEFAULT_TEMPLATE
+    _ctx_store(user_id, "template", template)
+    return {"user_id": user_id, "template": template}
 
 async def set_user(user_id: int, **updates):
     u = await get_user(user_id)
     # Merge
     template = updates.get("template", u["template"])
-    await _db.execute("INSERT INTO users(user_id, template, joined_date) VALUES(?,?,?) "
-                      "ON CONFLICT(user_id) DO UPDATE SET template=excluded.template",
-                      (user_id, template, datetime.now().isoformat(timespec="seconds")))
-    await _db.commit()
+    async with transaction():
+        cur = await _db.execute("UPDATE users SET template = ? WHERE user_id = ?", (template, user_id))
+        created = cur.rowcount == 0
+        if created:
+            now = int(time.time())
+            await _db.execute("INSERT INTO users(user_id, template, joined_date, last_seen) VALUES(?,?,?,?)",
+                              (user_id, template, datetime.fromtimestamp(now).isoformat(timespec="seconds"), now))
+            await _db.execute("INSERT INTO activity_buckets(bucket, users) VALUES(?, 1) "
+                              "ON CONFLICT(bucket) DO UPDATE SET users = users + 1",
+                              (now // ACTIVITY_BUCKET_SECONDS,))
+        _ctx_store(user_id, "template", template or DEFAULT_TEMPLATE)
+    if created:
+        incr_counter("stats_users")
 
 async def get_active_caption_id(user_id: int) -> Optional[int]:
-    cur = await _db.execute("SELECT active_caption_id FROM state WHERE user_id = ?", (user_id,))
-    row = await cur.fetchone()
-    return row["active_caption_id"] if row else None
+    active = _ctx_lookup(user_id, "active")
+    if active is not _MISSING:
+        return active
+    row = await _fetchone("SELECT active_caption_id FROM state WHERE user_id = ?", (user_id,))
+    active = row["active_caption_id"] if row else None
+    _ctx_store(user_id, "active", active)
+    return active
 
 async def set_active_caption_id(user_id: int, caption_id: Optional[int]):
-    await _db.execute("INSERT INTO state(user_id, active_caption_id) VALUES(?,?) "
-                      "ON CONFLICT(user_id) DO UPDATE SET active_caption_id=excluded.active_caption_id",
-                      (user_id, caption_id))
-    await _db.commit()
+    async with transaction():
+        await _db.execute("INSERT INTO state(user_id, active_caption_id) VALUES(?,?) "
+                          "ON CONFLICT(user_id) DO UPDATE SET active_caption_id=excluded.active_caption_id",
+                          (user_id, caption_id))
+        _ctx_store(user_id, "active", caption_id)
 
 async def add_caption(user_id: int, name: str, version: Optional[str], lang: Optional[str]) -> Tuple[bool, str, Optional[int]]:
     name = (name or "").strip()
@@ -531,42 +1318,82 @@ async def add_caption(user_id: int, name: str, version: Optional[str], lang: Opt
     lang = (lang or "").strip()
     if not name:
         return False, "❌ Name is required (/n).", None
-    try:
-        await _db.execute(
-            "INSERT INTO captions(user_id, name, name_norm, version, version_norm, lang, lang_norm, next_ep, zero_pad) "
-            "VALUES(?,?,?,?,?,?,?,1,0)",
-            (user_id, name, norm(name), (version or None), norm(version), (lang or None), norm(lang))
-        )
-        await _db.commit()
-        cur = await _db.execute("SELECT last_insert_rowid() AS lid")
-        lid = (await cur.fetchone())["lid"]
+    # A UNIQUE violation only aborts the INSERT statement, not the enclosing
+    # transaction, so it is handled inside the scope.
+    async with transaction():
+        try:
+            cur = await _db.execute(
+                "INSERT INTO captions(user_id, name, name_norm, version, version_norm, lang, lang_norm, next_ep, zero_pad) "
+                "VALUES(?,?,?,?,?,?,?,1,0)",
+                (user_id, name, norm(name), (version or None), norm(version), (lang or None), norm(lang))
+            )
+            lid = cur.lastrowid
+        except aiosqlite.IntegrityError:
+            lid = None
+        if lid is not None:
+            _ctx_drop(user_id, "captions", int(lid))
+    if lid is not None:
         return True, f"✅ Caption saved: **{name}** — {version or '—'} — {lang or '—'}", int(lid)
-    except aiosqlite.IntegrityError:
-        # If it already exists, fetch and return its id
-        cur = await _db.execute(
-            "SELECT id FROM captions WHERE user_id=? AND name_norm=? AND version_norm=? AND lang_norm=?",
-            (user_id, norm(name), norm(version), norm(lang))
-        )
-        existing = await cur.fetchone()
-        if existing:
-            return False, "⚠️ This caption already exists.", existing["id"]
-        return False, "⚠️ This caption already exists.", None
+    # If it already exists, fetch and return its id
+    existing = await _fetchone(
+        "SELECT id FROM captions WHERE user_id=? AND name_norm=? AND version_norm=? AND lang_norm=?",
+        (user_id, norm(name), norm(version), norm(lang))
+    )
+    if existing:
+        return False, "⚠️ This caption already exists.", existing["id"]
+    return False, "⚠️ This caption already exists.", None
 
 async def list_captions(user_id: int) -> List[dict]:
-    cur = await _db.execute(
+    rows = await _fetchall(
         "SELECT id AS _id, user_id, name, version, lang, next_ep, zero_pad FROM captions WHERE user_id = ? ORDER BY name_norm ASC",
         (user_id,)
     )
-    rows = await cur.fetchall()
     return [dict(row) for row in rows]
 
-async def get_caption(user_id: int, caption_id: int) -> Optional[dict]:
-    cur = await _db.execute(
-        "SELECT id AS _id, user_id, name, version, lang, next_ep, zero_pad FROM captions WHERE id = ? AND user_id = ?",
-        (caption_id, user_id)
+async def list_captions_page(user_id: int, after_id: int = 0, limit: int = 10) -> List[dict]:
+    """
+    One page of captions in (name_norm, id) order, starting after the
+    caption `after_id` (0 = from the start). The cursor is a caption id so
+    it fits in callback data; SQL resolves it to its sort key.
+    """
+    cols = "id AS _id, user_id, name, version, lang, next_ep, zero_pad"
+    if not after_id:
+        rows = await _fetchall(
+            f"SELECT {cols} FROM captions WHERE user_id = ? ORDER BY name_norm, id LIMIT ?",
+            (user_id, limit)
+        )
+    else:
+        rows = await _fetchall(
+            f"SELECT {cols} FROM captions WHERE user_id = ? "
+            "AND (name_norm, id) > (SELECT name_norm, id FROM captions WHERE id = ? AND user_id = ?) "
+            "ORDER BY name_norm, id LIMIT ?",
+            (user_id, after_id, user_id, limit)
+        )
+    return [dict(row) for row in rows]
+
+async def captions_page_before(user_id: int, first_id: int, limit: int = 10) -> int:
+    """Cursor (after_id) of the page that ends right before caption `first_id`."""
+    row = await _fetchone(
+        "SELECT id FROM captions WHERE user_id = ? "
+        "AND (name_norm, id) < (SELECT name_norm, id FROM captions WHERE id = ? AND user_id = ?) "
+        "ORDER BY name_norm DESC, id DESC LIMIT 1 OFFSET ?",
+        (user_id, first_id, user_id, limit)
     )
-    row = await cur.fetchone()
-    return dict(row) if row else None
+    return row["id"] if row else 0
+
+async def count_captions(user_id: int) -> int:
+    return (await _fetchone("SELECT COUNT(*) AS c FROM captions WHERE user_id = ?", (user_id,)))["c"]
+
+async def get_caption(user_id: int, caption_id: int) -> Optional[dict]:
+    cap = _ctx_lookup(user_id, "captions", caption_id)
+    if cap is _MISSING:
+        row = await _fetchone(
+            "SELECT id AS _id, user_id, name, version, lang, next_ep, zero_pad FROM captions WHERE id = ? AND user_id = ?",
+            (caption_id, user_id)
+        )
+        cap = dict(row) if row else None
+        _ctx_store(user_id, "captions", cap, caption_id)
+    return dict(cap) if cap else None
 
 async def set_caption_fields(user_id: int, caption_id: int, **fields):
     # Prepare a dynamic update
@@ -579,22 +1406,56 @@ async def set_caption_fields(user_id: int, caption_id: int, **fields):
     if not sets:
         return
     vals.extend([caption_id, user_id])
-    await _db.execute(f"UPDATE captions SET {', '.join(sets)} WHERE id = ? AND user_id = ?", vals)
-    await _db.commit()
+    async with transaction():
+        await _db.execute(f"UPDATE captions SET {', '.join(sets)} WHERE id = ? AND user_id = ?", vals)
+        _ctx_patch(user_id, "captions", {k: v for k, v in fields.items() if k in allowed}, caption_id)
+
+async def reserve_episodes(user_id: int, caption_id: int, n: int = 1) -> Optional[int]:
+    """
+    Atomically hand out `n` consecutive episode numbers for a caption.
+    Returns the first reserved episode, or None if the caption is gone.
+    """
+    n = max(1, int(n))
+    async with transaction():
+        cur = await _db.execute(
+            "UPDATE captions SET next_ep = next_ep + ? WHERE id = ? AND user_id = ? RETURNING next_ep",
+            (n, caption_id, user_id)
+        )
+        row = await cur.fetchone()
+        await cur.close()
+        if not row:
+            return None
+        _ctx_patch(user_id, "captions", {"next_ep": row["next_ep"]}, caption_id)
+    return row["next_ep"] - n
+
+async def release_episodes(user_id: int, caption_id: int, start: int, n: int = 1) -> bool:
+    """
+    Give back a reservation whose sends failed. Only succeeds while it is
+    still the latest one (nothing reserved after it), otherwise the gap stays.
+    """
+    n = max(1, int(n))
+    async with transaction():
+        cur = await _db.execute(
+            "UPDATE captions SET next_ep = ? WHERE id = ? AND user_id = ? AND next_ep = ?",
+            (start, caption_id, user_id, start + n)
+        )
+        if cur.rowcount > 0:
+            _ctx_patch(user_id, "captions", {"next_ep": start}, caption_id)
+    return cur.rowcount > 0
 
 async def delete_caption(user_id: int, caption_id: int) -> bool:
-    await _db.execute("DELETE FROM captions WHERE id = ? AND user_id = ?", (caption_id, user_id))
-    await _db.commit()
-    cur = await _db.execute("SELECT changes() AS ch")
-    ch = (await cur.fetchone())["ch"]
-    return ch > 0
+    async with transaction():
+        cur = await _db.execute("DELETE FROM captions WHERE id = ? AND user_id = ?", (caption_id, user_id))
+        _ctx_store(user_id, "captions", None, caption_id)
+        # Rotation rows go with it (ON DELETE CASCADE)
+        _ctx_drop(user_id, "multi")
+    return cur.rowcount > 0
 
 # -----------------------------
 # Settings helpers
 # -----------------------------
 async def _get_setting_int(key: str, default_val: int) -> int:
-    cur = await _db.execute("SELECT value FROM settings WHERE key = ?", (key,))
-    row = await cur.fetchone()
+    row = await _fetchone("SELECT value FROM settings WHERE key = ?", (key,))
     if not row: return default_val
     try:
         return int(row["value"])
@@ -602,8 +1463,7 @@ async def _get_setting_int(key: str, default_val: int) -> int:
         return default_val
 
 async def _get_setting_str(key: str, default_val: str) -> str:
-    cur = await _db.execute("SELECT value FROM settings WHERE key = ?", (key,))
-    row = await cur.fetchone()
+    row = await _fetchone("SELECT value FROM settings WHERE key = ?", (key,))
     return row["value"] if row else default_val
 
 async def _set_setting(key: str, val: str):
@@ -615,34 +1475,40 @@ async def _set_setting(key: str, val: str):
 # User tag preferences
 # -----------------------------
 async def get_user_tag_prefs(user_id: int) -> dict:
-    cur = await _db.execute("SELECT tag, position FROM user_prefs WHERE user_id = ?", (user_id,))
-    row = await cur.fetchone()
-    if not row:
-        return {"tag": None, "position": "end"}
-    pos = row["position"] if row["position"] in ("start", "end") else "end"
-    return {"tag": row["tag"], "position": pos}
+    prefs = _ctx_lookup(user_id, "prefs")
+    if prefs is _MISSING:
+        row = await _fetchone("SELECT tag, position FROM user_prefs WHERE user_id = ?", (user_id,))
+        if not row:
+            prefs = {"tag": None, "position": "end"}
+        else:
+            pos = row["position"] if row["position"] in ("start", "end") else "end"
+            prefs = {"tag": row["tag"], "position": pos}
+        _ctx_store(user_id, "prefs", prefs)
+    return dict(prefs)
 
 async def set_user_tag(user_id: int, tag: Optional[str]):
     tag = (tag or "").strip()
-    if not tag:
-        await _db.execute(
-            "INSERT INTO user_prefs(user_id, tag) VALUES(?, NULL) ON CONFLICT(user_id) DO UPDATE SET tag=NULL",
-            (user_id,)
-        )
-    else:
-        await _db.execute(
-            "INSERT INTO user_prefs(user_id, tag) VALUES(?, ?) ON CONFLICT(user_id) DO UPDATE SET tag=excluded.tag",
-            (user_id, tag)
-        )
-    await _db.commit()
+    async with transaction():
+        if not tag:
+            await _db.execute(
+                "INSERT INTO user_prefs(user_id, tag) VALUES(?, NULL) ON CONFLICT(user_id) DO UPDATE SET tag=NULL",
+                (user_id,)
+            )
+        else:
+            await _db.execute(
+                "INSERT INTO user_prefs(user_id, tag) VALUES(?, ?) ON CONFLICT(user_id) DO UPDATE SET tag=excluded.tag",
+                (user_id, tag)
+            )
+        _ctx_patch(user_id, "prefs", {"tag": tag or None})
 
 async def set_tag_position(user_id: int, position: str):
     position = position if position in ("start", "end") else "end"
-    await _db.execute(
-        "INSERT INTO user_prefs(user_id, position) VALUES(?, ?) ON CONFLICT(user_id) DO UPDATE SET position=excluded.position",
-        (user_id, position)
-    )
-    await _db.commit()
+    async with transaction():
+        await _db.execute(
+            "INSERT INTO user_prefs(user_id, position) VALUES(?, ?) ON CONFLICT(user_id) DO UPDATE SET position=excluded.position",
+            (user_id, position)
+        )
+        _ctx_patch(user_id, "prefs", {"position": position})
 
 def _normalize_tag(s: str) -> str:
     s = (s or "").strip()
@@ -677,9 +1543,10 @@ def _clean_base_filename(name: str) -> str:
     base = base.strip()
     return INVALID_FS_CHARS.sub("_", base)
 
-async def build_final_filename(user_id: int, original_name: str) -> str:
+async def build_final_filename(user_id: int, original_name: str, prefs: Optional[dict] = None) -> str:
     """Return a safe filename with the user's tag at start or end.
     If no tag saved, only cleans invalid characters.
+    Pass `prefs` (from load_media_context) to skip the lookup.
     """
     original_name = original_name or "file"
     base, ext = os.path.splitext(original_name)
@@ -687,7 +1554,8 @@ async def build_final_filename(user_id: int, original_name: str) -> str:
         ext = ""
     base = _clean_base_filename(base)
 
-    prefs = await get_user_tag_prefs(user_id)
+    if prefs is None:
+        prefs = await get_user_tag_prefs(user_id)
     tag_norm = _normalize_tag(prefs.get("tag") or "")
     if tag_norm:
         if prefs.get("position") == "start":
@@ -703,47 +1571,295 @@ async def build_final_filename(user_id: int, original_name: str) -> str:
 # -----------------------------
 # Multi-caption helpers
 # -----------------------------
+# Rank of an item inside its user's rotation (ordinals may have gaps)
+_MULTI_RANK = "(SELECT COUNT(*) FROM user_multi_items AS r WHERE r.user_id = i.user_id AND r.ordinal < i.ordinal)"
+_MULTI_COUNT = "(SELECT COUNT(*) FROM user_multi_items AS n WHERE n.user_id = {uid})"
+
 async def _multi_row(user_id: int) -> dict:
-    cur = await _db.execute("SELECT enabled, ids_json, pointer FROM user_multi WHERE user_id = ?", (user_id,))
-    row = await cur.fetchone()
+    st = _ctx_lookup(user_id, "multi")
+    if st is not _MISSING:
+        return {"enabled": st["enabled"], "ids": list(st["ids"]), "pointer": st["pointer"]}
+    row = await _fetchone(
+        "SELECT m.enabled, m.pointer, "
+        "(SELECT json_group_array(caption_id) FROM "
+        " (SELECT caption_id FROM user_multi_items WHERE user_id = m.user_id ORDER BY ordinal)) AS ids_json "
+        "FROM user_multi m WHERE m.user_id = ?",
+        (user_id,)
+    )
     if not row:
-        await _db.execute("INSERT INTO user_multi(user_id, enabled, ids_json, pointer) VALUES(?,0,'[]',0)", (user_id,))
-        await _db.commit()
-        return {"enabled": 0, "ids": [], "pointer": 0}
-    return {"enabled": int(row["enabled"]), "ids": json.loads(row["ids_json"] or "[]"), "pointer": int(row["pointer"])}
+        async with transaction():
+            await _db.execute("INSERT OR IGNORE INTO user_multi(user_id, enabled, pointer) VALUES(?,0,0)", (user_id,))
+        st = {"enabled": 0, "ids": [], "pointer": 0}
+    else:
+        st = {"enabled": int(row["enabled"]), "ids": json.loads(row["ids_json"] or "[]"), "pointer": int(row["pointer"])}
+    _ctx_store(user_id, "multi", st)
+    return {"enabled": st["enabled"], "ids": list(st["ids"]), "pointer": st["pointer"]}
 
 async def get_multi_state(user_id: int) -> dict:
     return await _multi_row(user_id)
 
 async def set_multi_enabled(user_id: int, enabled: bool):
-    await _db.execute("UPDATE user_multi SET enabled=? WHERE user_id=?", (1 if enabled else 0, user_id))
-    await _db.commit()
+    async with transaction():
+        await _db.execute("INSERT INTO user_multi(user_id, enabled) VALUES(?,?) "
+                          "ON CONFLICT(user_id) DO UPDATE SET enabled=excluded.enabled",
+                          (user_id, 1 if enabled else 0))
+        _ctx_patch(user_id, "multi", {"enabled": 1 if enabled else 0})
 
 async def set_multi_ids(user_id: int, ids: List[int], keep_pointer: bool = False):
-    if not keep_pointer:
-        await _db.execute("UPDATE user_multi SET ids_json=?, pointer=0 WHERE user_id=?", (json.dumps(ids), user_id))
-    else:
-        await _db.execute("UPDATE user_multi SET ids_json=? WHERE user_id=?", (json.dumps(ids), user_id))
-    await _db.commit()
+    async with transaction():
+        await _db.execute("DELETE FROM user_multi_items WHERE user_id = ?", (user_id,))
+        # Only the user's own, existing captions make it into the rotation
+        await _db.executemany(
+            "INSERT OR IGNORE INTO user_multi_items(user_id, ordinal, caption_id) "
+            "SELECT ?, ?, id FROM captions WHERE id = ? AND user_id = ?",
+            [(user_id, i, int(cid), user_id) for i, cid in enumerate(ids)]
+        )
+        if not keep_pointer:
+            await _db.execute("INSERT INTO user_multi(user_id, pointer) VALUES(?,0) "
+                              "ON CONFLICT(user_id) DO UPDATE SET pointer=0", (user_id,))
+        else:
+            await _db.execute("INSERT OR IGNORE INTO user_multi(user_id) VALUES(?)", (user_id,))
+        _ctx_drop(user_id, "multi")
 
 async def clear_multi(user_id: int):
-    await _db.execute("UPDATE user_multi SET enabled=0, ids_json='[]', pointer=0 WHERE user_id= ?", (user_id,))
-    await _db.commit()
+    async with transaction():
+        await _db.execute("DELETE FROM user_multi_items WHERE user_id = ?", (user_id,))
+        await _db.execute("UPDATE user_multi SET enabled=0, pointer=0 WHERE user_id= ?", (user_id,))
+        _ctx_patch(user_id, "multi", {"enabled": 0, "ids": [], "pointer": 0})
 
 async def toggle_multi_id(user_id: int, cid: int):
-    st = await _multi_row(user_id)
-    ids = st["ids"]
-    if cid in ids:
-        ids = [x for x in ids if x != cid]
+    # Remove if selected, otherwise append after the last ordinal; no read-modify-write
+    async with transaction():
+        cur = await _db.execute("DELETE FROM user_multi_items WHERE user_id = ? AND caption_id = ?", (user_id, cid))
+        if cur.rowcount > 0:
+            entry = _user_ctx.get(user_id, {}).get("multi")
+            if entry is not None:
+                _ctx_patch(user_id, "multi", {"ids": [x for x in entry["ids"] if x != cid]})
+            return
+        await _db.execute("INSERT OR IGNORE INTO user_multi(user_id) VALUES(?)", (user_id,))
+        cur = await _db.execute(
+            "INSERT INTO user_multi_items(user_id, ordinal, caption_id) "
+            "SELECT ?, (SELECT COALESCE(MAX(ordinal) + 1, 0) FROM user_multi_items WHERE user_id = ?), id "
+            "FROM captions WHERE id = ? AND user_id = ?",
+            (user_id, user_id, cid, user_id)
+        )
+        entry = _user_ctx.get(user_id, {}).get("multi")
+        if cur.rowcount > 0 and entry is not None:
+            _ctx_patch(user_id, "multi", {"ids": entry["ids"] + [cid]})
+
+_ADVANCE_MULTI_SQL = f"""
+UPDATE user_multi
+SET pointer = (pointer + 1) % {_MULTI_COUNT.format(uid="user_multi.user_id")}
+WHERE user_id = ? AND enabled = 1
+  AND EXISTS (SELECT 1 FROM user_multi_items WHERE user_id = user_multi.user_id)
+RETURNING pointer, (
+    SELECT i.caption_id FROM user_multi_items AS i
+    WHERE i.user_id = user_multi.user_id
+      AND {_MULTI_RANK} = (user_multi.pointer + {_MULTI_COUNT.format(uid="user_multi.user_id")} - 1)
+                          % {_MULTI_COUNT.format(uid="user_multi.user_id")}
+) AS caption_id
+"""
+
+async def advance_multi_pointer(user_id: int) -> Optional[Tuple[int, int]]:
+    """
+    Take the caption at the rotation pointer and move the pointer on, in a
+    single statement. Returns (caption_id, new_pointer), or None when
+    multi-caption is off or the selection is empty.
+    """
+    async with transaction():
+        cur = await _db.execute(_ADVANCE_MULTI_SQL, (user_id,))
+        row = await cur.fetchone()
+        await cur.close()
+        if not row:
+            return None
+        _ctx_patch(user_id, "multi", {"pointer": row["pointer"]})
+    return int(row["caption_id"]), int(row["pointer"])
+
+async def rewind_multi_pointer(user_id: int, pointer: int) -> bool:
+    """Undo advance_multi_pointer (failed send) if nothing advanced it since."""
+    async with transaction():
+        cur = await _db.execute(
+            f"UPDATE user_multi SET pointer = (pointer + {_MULTI_COUNT.format(uid='user_multi.user_id')} - 1) "
+            f"% {_MULTI_COUNT.format(uid='user_multi.user_id')} "
+            "WHERE user_id = ? AND pointer = ? "
+            "AND EXISTS (SELECT 1 FROM user_multi_items WHERE user_id = user_multi.user_id) "
+            "RETURNING pointer",
+            (user_id, pointer)
+        )
+        row = await cur.fetchone()
+        await cur.close()
+        if row:
+            _ctx_patch(user_id, "multi", {"pointer": row["pointer"]})
+    return row is not None
+
+# -----------------------------
+# Media hot path
+# -----------------------------
+_MEDIA_CONTEXT_SQL = f"""
+SELECT u.user_id AS known_user, u.template,
+       p.user_id AS has_prefs, p.tag, p.position,
+       s.active_caption_id,
+       m.user_id AS has_multi, m.enabled, m.pointer,
+       (SELECT json_group_array(caption_id) FROM
+         (SELECT caption_id FROM user_multi_items WHERE user_id = k.user_id ORDER BY ordinal)) AS ids_json,
+       c.id AS _id, c.name, c.version, c.lang, c.next_ep, c.zero_pad
+FROM (SELECT ? AS user_id) AS k
+LEFT JOIN users u      ON u.user_id = k.user_id
+LEFT JOIN user_prefs p ON p.user_id = k.user_id
+LEFT JOIN state s      ON s.user_id = k.user_id
+LEFT JOIN user_multi m ON m.user_id = k.user_id
+LEFT JOIN captions c   ON c.user_id = k.user_id AND c.id = (
+    CASE WHEN m.enabled = 1 AND EXISTS (SELECT 1 FROM user_multi_items WHERE user_id = k.user_id)
+         THEN (SELECT i.caption_id FROM user_multi_items AS i
+               WHERE i.user_id = k.user_id
+                 AND {_MULTI_RANK} = m.pointer % {_MULTI_COUNT.format(uid="k.user_id")})
+         ELSE s.active_caption_id END)
+"""
+
+def _media_target_id(multi: dict, active: Optional[int]) -> Optional[int]:
+    if multi.get("enabled") and multi.get("ids"):
+        return int(multi["ids"][multi.get("pointer", 0) % len(multi["ids"])])
+    return active
+
+async def load_media_context(user_id: int) -> dict:
+    """
+    Everything on_media needs to caption one file: template, tag prefs,
+    active caption id, multi-caption state and the caption to use now.
+    Served from the user context cache when warm, otherwise fetched with a
+    single joined query (one hop through the aiosqlite worker thread).
+    """
+    template = _ctx_lookup(user_id, "template")
+    prefs = _ctx_lookup(user_id, "prefs")
+    active = _ctx_lookup(user_id, "active")
+    multi = _ctx_lookup(user_id, "multi")
+    if _MISSING not in (template, prefs, active, multi):
+        cid = _media_target_id(multi, active)
+        cap = _ctx_lookup(user_id, "captions", cid) if cid else None
+        if cap is not _MISSING:
+            return {
+                "template": template,
+                "prefs": dict(prefs),
+                "active_caption_id": active,
+                "multi": {"enabled": multi["enabled"], "ids": list(multi["ids"]), "pointer": multi["pointer"]},
+                "caption_id": cid,
+                "caption": dict(cap) if cap else None,
+            }
+
+    row = await _fetchone(_MEDIA_CONTEXT_SQL, (user_id,))
+    if row["known_user"] is None:
+        await track_user(user_id)
+    template = row["template"] or DEFAULT_TEMPLATE
+    if row["has_prefs"] is None:
+        prefs = {"tag": None, "position": "end"}
+    else:
+        prefs = {"tag": row["tag"], "position": row["position"] if row["position"] in ("start", "end") else "end"}
+    active = row["active_caption_id"]
+    if row["has_multi"] is None:
+        multi = {"enabled": 0, "ids": [], "pointer": 0}
     else:
-        ids = ids + [cid]
-    await set_multi_ids(user_id, ids, keep_pointer=True)
+        multi = {"enabled": int(row["enabled"]), "ids": json.loads(row["ids_json"] or "[]"), "pointer": int(row["pointer"])}
+    cid = _media_target_id(multi, active)
+    cap = None
+    if row["_id"] is not None:
+        cap = {k: row[k] for k in ("_id", "name", "version", "lang", "next_ep", "zero_pad")}
+        cap["user_id"] = user_id
+
+    _ctx_store(user_id, "template", template)
+    _ctx_store(user_id, "prefs", prefs)
+    _ctx_store(user_id, "active", active)
+    _ctx_store(user_id, "multi", multi)
+    if cid:
+        _ctx_store(user_id, "captions", cap, cid)
+    return {
+        "template": template,
+        "prefs": dict(prefs),
+        "active_caption_id": active,
+        "multi": {"enabled": multi["enabled"], "ids": list(multi["ids"]), "pointer": multi["pointer"]},
+        "caption_id": cid,
+        "caption": dict(cap) if cap else None,
+    }
+
 
-async def advance_multi_pointer(user_id: int):
-    st = await _multi_row(user_id)
-    if not st["ids"]:
+# -----------------------------
+# File id cache
+# -----------------------------
+# Renaming the same source document to the same final name again reuses the
+# file_id of the first upload instead of downloading/uploading the bytes.
+# Lookups are plain reads on the reader pool; the last_used bumps they imply
+# are kept in memory and written in bulk by flush_file_id_usage() (and before
+# any eviction, so the LRU order stays right).
+_file_id_rows = 0  # row count, kept in memory so eviction needs no COUNT(*)
+_file_id_used: dict[tuple, int] = {}  # (file_unique_id, final_name) -> last hit (epoch)
+
+async def _load_file_id_count():
+    global _file_id_rows
+    row = await _fetchone("SELECT COUNT(*) AS n FROM file_id_cache")
+    _file_id_rows = row["n"]
+
+async def get_cached_file_id(file_unique_id: str, final_name: str) -> Optional[str]:
+    """file_id of an earlier upload of this document under final_name (marks it used)."""
+    row = await _fetchone(
+        "SELECT file_id FROM file_id_cache WHERE file_unique_id = ? AND final_name = ?",
+        (file_unique_id, final_name)
+    )
+    if not row:
+        return None
+    _file_id_used[(file_unique_id, final_name)] = int(time.time())
+    return row["file_id"]
+
+async def flush_file_id_usage():
+    if not _file_id_used:
         return
-    ptr = (st["pointer"] + 1) % len(st["ids"])
-    await _db.execute("UPDATE user_multi SET pointer=? WHERE user_id=?", (ptr, user_id))
-    await _db.commit()
+    pending = dict(_file_id_used)
+    _file_id_used.clear()
+    try:
+        async with transaction():
+            await _write_file_id_usage(pending)
+    except Exception:
+        # Keep the newest hit of each entry for the next attempt
+        for key, ts in pending.items():
+            _file_id_used[key] = max(ts, _file_id_used.get(key, 0))
+        raise
+
+async def _write_file_id_usage(pending: dict):
+    await _db.executemany(
+        "UPDATE file_id_cache SET last_used = MAX(last_used, ?) WHERE file_unique_id = ? AND final_name = ?",
+        [(ts, uid, name) for (uid, name), ts in pending.items()]
+    )
 
+async def put_cached_file_id(file_unique_id: str, final_name: str, file_id: str):
+    global _file_id_rows
+    async with transaction():
+        now = int(time.time())
+        cur = await _db.execute(
+            "INSERT OR IGNORE INTO file_id_cache(file_unique_id, final_name, file_id, last_used) VALUES(?,?,?,?)",
+            (file_unique_id, final_name, file_id, now)
+        )
+        if cur.rowcount:
+            _file_id_rows += 1
+        else:
+            await _db.execute(
+                "UPDATE file_id_cache SET file_id = ?, last_used = ? WHERE file_unique_id = ? AND final_name = ?",
+                (file_id, now, file_unique_id, final_name)
+            )
+        # LRU eviction through the last_used index, pending hits applied first
+        if _file_id_rows > FILE_ID_CACHE_MAX:
+            if _file_id_used:
+                await _write_file_id_usage(_file_id_used)
+                _file_id_used.clear()
+            cur = await _db.execute(
+                "DELETE FROM file_id_cache WHERE rowid IN "
+                "(SELECT rowid FROM file_id_cache ORDER BY last_used LIMIT ?)",
+                (_file_id_rows - FILE_ID_CACHE_MAX,)
+            )
+            _file_id_rows -= cur.rowcount
+
+async def forget_cached_file_id(file_unique_id: str, final_name: str):
+    """Drop an entry whose file_id Telegram no longer accepts."""
+    global _file_id_rows
+    async with transaction():
+        cur = await _db.execute(
+            "DELETE FROM file_id_cache WHERE file_unique_id = ? AND final_name = ?",
+            (file_unique_id, final_name)
+        )
+        _file_id_rows -= cur.rowcount
@@ -0,0 +1,159 @@
+import asyncio
+import heapq
+import itertools
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from config import (
+	OUTBOUND_RATE,
+	OUTBOUND_CHAT_INTERVAL,
+	OUTBOUND_GROUP_INTERVAL,
+	OUTBOUND_MAX_RETRIES,
+)
+
+
+# -----------------------------
+# Outbound rate limiting
+# -----------------------------
+# Every Bot API call goes through OutboundLimiter (Application.builder().rate_limiter()).
+# Calls that put messages into a chat are paced per chat (OUTBOUND_CHAT_INTERVAL,
+# OUTBOUND_GROUP_INTERVAL for groups) and then take a token from the global
+# bucket (OUTBOUND_RATE per second), handed out by priority. Pass the priority
+# as rate_limit_args on the call; the default is PRIORITY_INTERACTIVE.
+# RetryAfter pauses all traffic for the requested time and the call is retried.
+PRIORITY_INTERACTIVE = 0  # replies, edits, callback answers
+PRIORITY_MEDIA = 1        # captioned files sent back by the transfer workers
+PRIORITY_BULK = 2         # broadcast
+
+# Endpoints that count against Telegram's message limits
+_LIMITED_ENDPOINTS = frozenset({
+	"sendMessage", "sendDocument", "sendPhoto", "sendVideo", "sendAnimation", "sendAudio",
+	"sendMediaGroup", "copyMessage", "copyMessages", "forwardMessage", "forwardMessages",
+	"editMessageText", "editMessageCaption", "editMessageReplyMarkup",
+})
+
+
+class OutboundLimiter(BaseRateLimiter[int]):
+	def __init__(
+		self,
+		rate: float = OUTBOUND_RATE,
+		chat_interval: float = OUTBOUND_CHAT_INTERVAL,
+		group_interval: float = OUTBOUND_GROUP_INTERVAL,
+		max_retries: int = OUTBOUND_MAX_RETRIES,
+	):
+		self._rate = rate
+		self._chat_interval = chat_interval
+		self._group_interval = group_interval
+		self._max_retries = max_retries
+		# Global bucket, refilled continuously up to one second of traffic
+		self._tokens = rate
+		self._refilled = time.monotonic()
+		self._paused_until = 0.0
+		self._waiting: list = []  # heap of (priority, seq, future)
+		self._seq = itertools.count()
+		self._wakeup = asyncio.Event()
+		self._dispatcher: asyncio.Task | None = None
+		# Per chat: monotonic time of the next free slot
+		self._chat_next: dict[int, float] = {}
+		# Metrics
+		self._queued = 0
+		self._sent = 0
+		self._wait_total = 0.0
+		self._wait_max = 0.0
+		self._retries = 0
+
+	async def initialize(self):
+		if self._dispatcher is None:
+			self._dispatcher = asyncio.create_task(self._dispatch())
+
+	async def shutdown(self):
+		if self._dispatcher is not None:
+			self._dispatcher.cancel()
+			try:
+				await self._dispatcher
+			except asyncio.CancelledError:
+				pass
+			self._dispatcher = None
+
+	async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+		priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+		chat_id = data.get("chat_id") if endpoint in _LIMITED_ENDPOINTS else None
+		for attempt in range(self._max_retries + 1):
+			if endpoint in _LIMITED_ENDPOINTS:
+				await self._wait_turn(chat_id, priority)
+			try:
+				return await callback(*args, **kwargs)
+			except RetryAfter as e:
+				if attempt >= self._max_retries:
+					raise
+				delay = e.retry_after
+				if isinstance(delay, timedelta):
+					delay = delay.total_seconds()
+				self._retries += 1
+				# Flood control applies to the whole bot: hold everything back
+				self._paused_until = max(self._paused_until, time.monotonic() + delay)
+				await asyncio.sleep(delay)
+
+	def stats(self) -> dict:
+		return {
+			"queued": self._queued,
+			"sent": self._sent,
+			"avg_wait": self._wait_total / self._sent if self._sent else 0.0,
+			"max_wait": self._wait_max,
+			"retries": self._retries,
+		}
+
+	async def _wait_turn(self, chat_id, priority: int):
+		start = time.monotonic()
+		self._queued += 1
+		try:
+			if chat_id is not None:
+				await self._wait_chat(chat_id, start)
+			fut = asyncio.get_running_loop().create_future()
+			heapq.heappush(self._waiting, (priority, next(self._seq), fut))
+			self._wakeup.set()
+			await fut
+		finally:
+			self._queued -= 1
+		waited = time.monotonic() - start
+		self._sent += 1
+		self._wait_total += waited
+		self._wait_max = max(self._wait_max, waited)
+
+	async def _wait_chat(self, chat_id, now: float):
+		try:
+			group = int(chat_id) < 0
+		except (TypeError, ValueError):
+			group = False  # @channelusername
+		interval = self._group_interval if group else self._chat_interval
+		slot = max(now, self._chat_next.get(chat_id, 0.0))
+		self._chat_next[chat_id] = slot + interval
+		if len(self._chat_next) > 10000:
+			# Forget chats whose slot has passed
+			self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+		if slot > now:
+			await asyncio.sleep(slot - now)
+
+	async def _dispatch(self):
+		while True:
+			if not self._waiting:
+				self._wakeup.clear()
+				await self._wakeup.wait()
+				continue
+			now = time.monotonic()
+			self._tokens = min(self._rate, self._tokens + (now - self._refilled) * self._rate)
+			self._refilled = now
+			delay = self._paused_until - now
+			if self._tokens < 1:
+				delay = max(delay, (1 - self._tokens) / self._rate)
+			if delay > 0:
+				await asyncio.sleep(delay)
+				continue
+			_, _, fut = heapq.heappop(self._waiting)
+			if fut.done():
+				continue  # caller was cancelled
+			self._tokens -= 1
+			fut.set_result(None)
@@ -5,13 +5,36 @@ Run this to verify the new functionality works correctly.
 import asyncio
 from config import (
     init_db,
+    close_db,
     track_user,
     get_user_stats,
     get_all_user_ids,
+    iter_user_ids,
     clear_force_join_cache,
-    FORCE_JOIN_CACHE_TTL,
+    FORCE_JOIN_POSITIVE_TTL,
+    FORCE_JOIN_NEGATIVE_TTL,
+    transaction,
+    get_stats,
+    update_stats,
+    flush_counters,
+    flush_activity,
+    get_user,
+    set_user,
+    _get_setting_int,
+    add_caption,
+    delete_caption,
+    list_captions,
+    get_caption,
+    list_captions_page,
+    captions_page_before,
+    reserve_episodes,
+    release_episodes,
+    set_multi_ids,
+    set_multi_enabled,
+    get_multi_state,
+    advance_multi_pointer,
+    rewind_multi_pointer,
 )
-import time
 
 
 async def test_user_tracking():
@@ -29,6 +52,9 @@ async def test_user_tracking():
 
     print("[OK] Users created")
 
+    # Activity is buffered in memory; write it out before reading stats
+    await flush_activity()
+
     # Get stats
     stats = await get_user_stats()
     print(f"\nUser Statistics:")
@@ -53,6 +79,13 @@ async def test_get_all_users():
     user_ids = await get_all_user_ids()
     print(f"Total user IDs retrieved: {len(user_ids)}")
 
+    # Streaming iterator walks the same ids, in small keyset pages
+    streamed = [uid async for uid in iter_user_ids(chunk_size=2, include_unreachable=True)]
+    if streamed == sorted(user_ids):
+        print("[OK] iter_user_ids matches get_all_user_ids")
+    else:
+        print("[FAILED] iter_user_ids returned different ids")
+
     if len(user_ids) > 0:
         print(f"Sample IDs: {user_ids[:5]}")
         print("[OK] Test PASSED: User IDs retrieved successfully")
@@ -66,45 +99,45 @@ async def test_force_join_cache():
     print("TEST 3: Force-Join Cache")
     print("="*50)
 
-    # Import cache variable
-    from config import _force_join_cache
+    # Import cache internals
+    from config import _force_join_cache, _join_cache_get, _join_cache_put
 
-    print(f"Cache TTL: {FORCE_JOIN_CACHE_TTL} seconds")
+    print(f"Cache TTL: {FORCE_JOIN_POSITIVE_TTL}s joined / {FORCE_JOIN_NEGATIVE_TTL}s not joined")
 
-    # Simulate cache entry
+    # Simulate cache entries (per user and channel)
     test_user_id = 999999
-    current_time = time.time()
-
-    # Add to cache
-    _force_join_cache[test_user_id] = (True, current_time)
-    print(f"\n[OK] Added user {test_user_id} to cache")
-    print(f"   Cached as: joined=True, time={current_time}")
+    _join_cache_put(test_user_id, -1001, True)
+    _join_cache_put(test_user_id, -1002, False)
+    print(f"\n[OK] Added user {test_user_id} to cache for 2 channels")
 
     # Check cache
-    if test_user_id in _force_join_cache:
-        is_joined, timestamp = _force_join_cache[test_user_id]
-        age = time.time() - timestamp
-        print(f"\n[OK] Cache entry found:")
-        print(f"   is_joined: {is_joined}")
-        print(f"   age: {age:.2f} seconds")
-
-        if age < FORCE_JOIN_CACHE_TTL:
-            print(f"   [OK] Cache is still valid (< {FORCE_JOIN_CACHE_TTL}s)")
-        else:
-            print(f"   [WARNING] Cache expired (> {FORCE_JOIN_CACHE_TTL}s)")
+    joined = _join_cache_get(test_user_id, -1001)
+    not_joined = _join_cache_get(test_user_id, -1002)
+    print(f"\n[OK] Cache entries found: joined={joined}, not_joined={not_joined}")
+    if joined is True and not_joined is False:
+        print("   [OK] Positive and negative results are cached")
+    else:
+        print("   [WARNING] Unexpected cached values")
+
+    # Expired entries are dropped on lookup
+    _join_cache_put(test_user_id, -1003, True, ttl=-1)
+    if _join_cache_get(test_user_id, -1003) is None:
+        print("   [OK] Expired entry ignored")
+    else:
+        print("   [WARNING] Expired entry returned")
 
     # Test clear cache
     clear_force_join_cache(test_user_id)
     print(f"\n[OK] Cleared cache for user {test_user_id}")
 
-    if test_user_id not in _force_join_cache:
+    if not any(key[0] == test_user_id for key in _force_join_cache):
         print("[OK] Test PASSED: Cache cleared successfully")
     else:
         print("[FAILED] Test FAILED: Cache not cleared")
 
     # Test clear all
-    _force_join_cache[111] = (True, time.time())
-    _force_join_cache[222] = (True, time.time())
+    _join_cache_put(111, -1001, True)
+    _join_cache_put(222, -1001, False)
     print(f"\n[OK] Added 2 test entries to cache")
 
     clear_force_join_cache()  # Clear all
@@ -116,6 +149,514 @@ async def test_force_join_cache():
         print(f"[FAILED] Test FAILED: {len(_force_join_cache)} entries remain")
 
 
+async def test_transaction_rollback():
+    """Test that a failed unit of work leaves no partial writes"""
+    print("\n" + "="*50)
+    print("TEST 4: Transaction Rollback")
+    print("="*50)
+
+    test_user_id = 111111
+    before = (await get_user(test_user_id))["template"]
+    try:
+        async with transaction():
+            await set_user(test_user_id, template="rolled back {ep}")
+            raise RuntimeError("simulated failure")
+    except RuntimeError:
+        pass
+    after = (await get_user(test_user_id))["template"]
+
+    if after == before:
+        print("[OK] Test PASSED: Failed transaction rolled back")
+    else:
+        print(f"[FAILED] Test FAILED: {before!r} -> {after!r}")
+
+
+async def test_stats_counters():
+    """Test in-memory stats counters and their flush"""
+    print("\n" + "="*50)
+    print("TEST 5: Stats Counters")
+    print("="*50)
+
+    before = await get_stats()
+    await update_stats(files_delta=1, bytes_delta=1024)
+    after = await get_stats()
+    print(f"Before: {before}")
+    print(f"After:  {after}")
+
+    await flush_counters()
+    persisted = await _get_setting_int("stats_files", 0)
+    print(f"Persisted files counter: {persisted}")
+
+    if after["files"] == before["files"] + 1 and persisted == after["files"]:
+        print("[OK] Test PASSED: Counters updated in memory and flushed")
+    else:
+        print("[FAILED] Test FAILED: Counter mismatch")
+
+
+async def _fresh_captions(user_id: int, names: list) -> list:
+    """Replace the test user's captions with `names`; returns their ids in order."""
+    for cap in await list_captions(user_id):
+        await delete_caption(user_id, cap["_id"])
+    ids = []
+    for name in names:
+        _, _, cid = await add_caption(user_id, name, None, None)
+        ids.append(cid)
+    return ids
+
+
+async def test_episode_reservations():
+    """Test atomic episode reservation and release"""
+    print("\n" + "="*50)
+    print("TEST 6: Episode Reservations")
+    print("="*50)
+
+    test_user_id = 777001
+    (cid,) = await _fresh_captions(test_user_id, ["Reserve Test"])
+
+    # Concurrent files must never share an episode number
+    eps = await asyncio.gather(*(reserve_episodes(test_user_id, cid) for _ in range(20)))
+    print(f"Reserved: {sorted(eps)}")
+    if sorted(eps) == list(range(1, 21)):
+        print("[OK] Concurrent reservations are unique and consecutive")
+    else:
+        print("[FAILED] Duplicate or missing episode numbers")
+
+    # A batch takes consecutive numbers; only the latest reservation can be given back
+    start = await reserve_episodes(test_user_id, cid, 3)
+    released_old = await release_episodes(test_user_id, cid, 20)
+    released_new = await release_episodes(test_user_id, cid, start, 3)
+    next_ep = (await get_caption(test_user_id, cid))["next_ep"]
+    print(f"Batch start: {start}, release older: {released_old}, release latest: {released_new}, next: {next_ep}")
+
+    if start == 21 and not released_old and released_new and next_ep == 21:
+        print("[OK] Test PASSED: Only the latest reservation is released")
+    else:
+        print("[FAILED] Test FAILED: Unexpected release behaviour")
+
+
+async def test_multi_rotation():
+    """Test the multi-caption rotation pointer"""
+    print("\n" + "="*50)
+    print("TEST 7: Multi-Caption Rotation")
+    print("="*50)
+
+    test_user_id = 777002
+    ids = await _fresh_captions(test_user_id, ["Rot A", "Rot B", "Rot C"])
+    await set_multi_ids(test_user_id, ids)
+    await set_multi_enabled(test_user_id, True)
+
+    claimed = [await advance_multi_pointer(test_user_id) for _ in range(4)]
+    order = [cid for cid, _ in claimed]
+    print(f"Rotation: {order}")
+    if order == ids + ids[:1]:
+        print("[OK] Pointer rotates through the selection and wraps around")
+    else:
+        print("[FAILED] Unexpected rotation order")
+
+    # Undo the last claim: the same caption comes up again
+    rewound = await rewind_multi_pointer(test_user_id, claimed[-1][1])
+    again = await advance_multi_pointer(test_user_id)
+    # A pointer value the rotation has moved away from is not rewound
+    stale = await rewind_multi_pointer(test_user_id, claimed[1][1])
+    if rewound and again[0] == ids[0] and not stale:
+        print("[OK] Rewind undoes only the latest advance")
+    else:
+        print(f"[FAILED] Rewind: {rewound}, again: {again}, stale rewind: {stale}")
+
+    # Deleting a caption takes it out of the rotation
+    await delete_caption(test_user_id, ids[1])
+    state = await get_multi_state(test_user_id)
+    cycle = [(await advance_multi_pointer(test_user_id))[0] for _ in range(4)]
+    print(f"After delete: ids={state['ids']}, rotation={cycle}")
+    if state["ids"] == [ids[0], ids[2]] and set(cycle) == {ids[0], ids[2]}:
+        print("[OK] Test PASSED: Deleted caption cascades out of the rotation")
+    else:
+        print("[FAILED] Test FAILED: Deleted caption still in rotation")
+
+
+async def test_caption_paging():
+    """Test keyset pagination of the caption list"""
+    print("\n" + "="*50)
+    print("TEST 8: Caption Paging")
+    print("="*50)
+
+    test_user_id = 777003
+    await _fresh_captions(test_user_id, [f"Page {i:02d}" for i in range(25)])
+    expected = [cap["_id"] for cap in await list_captions(test_user_id)]
+
+    # Forward: each page starts after the last id of the previous one
+    pages, after = [], 0
+    while True:
+        page = await list_captions_page(test_user_id, after, limit=10)
+        if not page:
+            break
+        pages.append([cap["_id"] for cap in page])
+        after = page[-1]["_id"]
+    print(f"Page sizes: {[len(p) for p in pages]}")
+    if sum(pages, []) == expected:
+        print("[OK] Forward pages cover every caption once, in order")
+    else:
+        print("[FAILED] Forward paging mismatch")
+
+    # Backward: the cursor before each page leads back to the previous page
+    ok = True
+    for prev, page in zip(pages, pages[1:]):
+        cursor = await captions_page_before(test_user_id, page[0], limit=10)
+        back = [cap["_id"] for cap in await list_captions_page(test_user_id, cursor, limit=10)]
+        ok = ok and back == prev
+    if ok and await captions_page_before(test_user_id, pages[0][0], limit=10) == 0:
+        print("[OK] Test PASSED: Pages round-trip in both directions")
+    else:
+        print("[FAILED] Test FAILED: Backward paging mismatch")
+
+
+async def test_media_context_cache():
+    """Test load_media_context against a cold and a warm user cache"""
+    print("\n" + "="*50)
+    print("TEST 9: Media Context Cache")
+    print("="*50)
+
+    from config import load_media_context, clear_user_cache, get_user_cache_stats, set_active_caption_id
+
+    test_user_id = 777004
+    first, second = await _fresh_captions(test_user_id, ["Ctx A", "Ctx B"])
+    await set_user(test_user_id, template="{name} E{ep}")
+    await set_active_caption_id(test_user_id, first)
+
+    # Cold: everything comes from one query
+    clear_user_cache(test_user_id)
+    cold = await load_media_context(test_user_id)
+    before = get_user_cache_stats()
+    # Warm: served from memory, no new misses
+    warm = await load_media_context(test_user_id)
+    after = get_user_cache_stats()
+    print(f"Cold: template={cold['template']!r}, caption={cold['caption'] and cold['caption']['name']}")
+    print(f"Hits +{after['hits'] - before['hits']}, misses +{after['misses'] - before['misses']}")
+
+    if cold == warm and cold["caption_id"] == first and cold["template"] == "{name} E{ep}":
+        print("[OK] Cold and warm lookups agree")
+    else:
+        print("[FAILED] Cold and warm contexts differ")
+
+    # Writes go through to the cached context
+    await set_active_caption_id(test_user_id, second)
+    switched = await load_media_context(test_user_id)
+    if after["misses"] == before["misses"] and after["hits"] > before["hits"] and switched["caption_id"] == second:
+        print("[OK] Test PASSED: Warm lookups hit the cache and see new writes")
+    else:
+        print(f"[FAILED] Test FAILED: stats {before} -> {after}, active {switched['caption_id']}")
+
+
+async def test_force_join_single_flight():
+    """Test that concurrent force-join checks for one user share one API call"""
+    print("\n" + "="*50)
+    print("TEST 10: Force-Join Single-Flight")
+    print("="*50)
+
+    from config import check_user_joined, add_force_channel, remove_force_channel, get_force_config, set_force_config
+
+    class FakeBot:
+        calls = 0
+
+        async def get_chat_member(self, chat_id, user_id):
+            FakeBot.calls += 1
+            await asyncio.sleep(0.05)
+            return type("Member", (), {"status": "member"})()
+
+    channel, test_user_id = -100777012, 777012
+    was_enabled = (await get_force_config())["enabled"]
+    await add_force_channel(channel, title="single-flight test")
+    await set_force_config({"enabled": True})
+    clear_force_join_cache(test_user_id)
+    try:
+        bot = FakeBot()
+        results = await asyncio.gather(*(check_user_joined(bot, test_user_id) for _ in range(10)))
+        shared = FakeBot.calls
+        await check_user_joined(bot, test_user_id, use_cache=False)
+        forced = FakeBot.calls - shared
+    finally:
+        await remove_force_channel(channel)
+        await set_force_config({"enabled": was_enabled})
+        clear_force_join_cache(test_user_id)
+    print(f"10 concurrent checks -> {shared} API call(s); forced recheck -> {forced}")
+
+    if all(ok for ok, _ in results) and shared == 1 and forced == 1:
+        print("[OK] Test PASSED: Concurrent checks share one call, a forced check makes its own")
+    else:
+        print("[FAILED] Test FAILED: Checks were not coalesced")
+
+
+async def test_transfer_scheduler():
+    """Test the transfer worker limits and the shutdown drain"""
+    print("\n" + "="*50)
+    print("TEST 11: Transfer Scheduler")
+    print("="*50)
+
+    import transfer
+
+    running: dict[int, int] = {}
+    peak = {"per_user": 0, "bytes": 0}
+    done, abandoned = [], []
+
+    def job(user_id, n, delay):
+        async def run():
+            running[user_id] = running.get(user_id, 0) + 1
+            peak["per_user"] = max(peak["per_user"], running[user_id])
+            peak["bytes"] = max(peak["bytes"], transfer.queue_stats()["bytes"])
+            try:
+                await asyncio.sleep(delay)
+                done.append((user_id, n))
+            finally:
+                running[user_id] -= 1
+
+        async def cancel():
+            abandoned.append((user_id, n))
+        return run, cancel
+
+    saved_max = transfer.TRANSFER_MAX_BYTES
+    transfer.TRANSFER_MAX_BYTES = 100
+    try:
+        transfer.start_workers(4)
+        for n in range(3):
+            for user_id in (1, 2, 3):
+                transfer.submit(user_id, 60, *job(user_id, n, 0.02))
+        await transfer.stop_workers(timeout=5)
+        in_order = all([n for uid, n in done if uid == user_id] == [0, 1, 2] for user_id in (1, 2, 3))
+        print(f"Done: {len(done)}, per-user peak: {peak['per_user']}, bytes peak: {peak['bytes']}")
+
+        # Drain timeout: the running job is cancelled, queued ones are abandoned
+        done.clear()
+        transfer.start_workers(1)
+        for n in range(3):
+            transfer.submit(9, 0, *job(9, n, 1))
+        await asyncio.sleep(0.05)
+        await transfer.stop_workers(timeout=0.1)
+    finally:
+        transfer.TRANSFER_MAX_BYTES = saved_max
+    print(f"After timeout: done={done}, abandoned={abandoned}, left={transfer.queue_stats()}")
+
+    if len(done) == 0 and peak["per_user"] == 1 and peak["bytes"] <= 100 and in_order:
+        print("[OK] Per-user and byte limits held, each user's jobs ran in order")
+    else:
+        print("[FAILED] Scheduler limits not respected")
+    if abandoned == [(9, 1), (9, 2)] and transfer.queue_stats() == {"queued": 0, "running": 0, "bytes": 0}:
+        print("[OK] Test PASSED: Queued jobs abandoned through their callback on shutdown")
+    else:
+        print("[FAILED] Test FAILED: Unexpected drain behaviour")
+
+
+async def test_per_user_updates():
+    """Test per-user ordering of concurrently processed updates"""
+    print("\n" + "="*50)
+    print("TEST 12: Per-User Update Ordering")
+    print("="*50)
+
+    from datetime import datetime
+    from telegram import Chat, Message, Update, User
+    import updates
+
+    def make_update(update_id, user_id):
+        message = Message(update_id, datetime.now(), Chat(user_id, "private"), from_user=User(user_id, "test", False))
+        return Update(update_id, message=message)
+
+    events = []
+
+    async def handle(update_id, user_id, delay):
+        events.append(("start", user_id, update_id))
+        await asyncio.sleep(delay)
+        events.append(("end", user_id, update_id))
+
+    processor = updates.PerUserUpdateProcessor(16)
+    # User 1's first update is slow; its second must still wait for it, user 2 must not
+    await asyncio.gather(
+        processor.process_update(make_update(1, 1), handle(1, 1, 0.1)),
+        processor.process_update(make_update(2, 1), handle(2, 1, 0)),
+        processor.process_update(make_update(3, 2), handle(3, 2, 0)),
+    )
+    user1 = [(kind, uid) for kind, user, uid in events if user == 1]
+    user2_end = events.index(("end", 2, 3))
+    print(f"Events: {events}")
+
+    if user1 == [("start", 1), ("end", 1), ("start", 2), ("end", 2)] and user2_end < events.index(("end", 1, 1)):
+        print("[OK] One user's updates run in order, other users run in parallel")
+    else:
+        print("[FAILED] Updates ran out of order or were serialized across users")
+    if not updates._locks:
+        print("[OK] Test PASSED: Idle users leave no lock behind")
+    else:
+        print(f"[FAILED] Test FAILED: {len(updates._locks)} locks left")
+
+
+async def test_ack_coalescing():
+    """Test that a burst of files gets one edited acknowledgement"""
+    print("\n" + "="*50)
+    print("TEST 13: Ack Coalescing")
+    print("="*50)
+
+    import acks
+
+    class FakeReply:
+        def __init__(self, chat):
+            self.chat = chat
+            self.text = None
+
+        async def edit_text(self, text):
+            self.chat.edits.append(text)
+
+    class FakeMessage:
+        chat_id = 777021
+
+        def __init__(self):
+            self.replies, self.edits = [], []
+
+        async def reply_text(self, text):
+            self.replies.append(text)
+            return FakeReply(self)
+
+    saved = acks.ACK_EDIT_INTERVAL, acks.ACK_QUIET
+    acks.ACK_EDIT_INTERVAL, acks.ACK_QUIET = 0.05, 0.2
+    try:
+        msg = FakeMessage()
+        for ep in range(1, 6):
+            await acks.ack(msg, 1, f"➡️ Next episode: {ep + 1}")
+        await asyncio.sleep(0.12)
+        burst = (len(msg.replies), list(msg.edits))
+        # After a quiet period the next file starts a new message
+        await asyncio.sleep(0.35)
+        await acks.ack(msg, 1, "➡️ Next episode: 7")
+        await asyncio.sleep(0.35)
+    finally:
+        acks.ACK_EDIT_INTERVAL, acks.ACK_QUIET = saved
+    print(f"Replies: {len(msg.replies)}, edits: {len(msg.edits)}")
+
+    if burst[0] == 1 and burst[1] and "5 files" in burst[1][-1] and "Next episode: 6" in burst[1][-1]:
+        print("[OK] Five files, one reply, edited with the running total")
+    else:
+        print(f"[FAILED] Burst not coalesced: {burst}")
+    if len(msg.replies) == 2 and not acks._bursts:
+        print("[OK] Test PASSED: A quiet period ends the burst")
+    else:
+        print("[FAILED] Test FAILED: Burst did not end after the quiet period")
+
+
+async def test_outbound_limiter():
+    """Test priority order and flood-control pauses in the outbound limiter"""
+    print("\n" + "="*50)
+    print("TEST 14: Outbound Limiter")
+    print("="*50)
+
+    from telegram.error import RetryAfter
+    from outbound import OutboundLimiter, PRIORITY_INTERACTIVE, PRIORITY_BULK
+
+    limiter = OutboundLimiter(rate=20, chat_interval=0, group_interval=0, max_retries=2)
+    await limiter.initialize()
+    order = []
+
+    def send(name, fail_once=False):
+        state = {"failed": not fail_once}
+
+        async def callback():
+            if not state["failed"]:
+                state["failed"] = True
+                raise RetryAfter(1)
+            order.append((name, asyncio.get_running_loop().time()))
+            return name
+        return callback
+
+    def call(callback, priority, chat_id=1):
+        return limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": chat_id}, priority)
+
+    try:
+        # Use up the burst allowance, then queue bulk before interactive
+        await asyncio.gather(*(call(send(f"warmup{i}"), PRIORITY_INTERACTIVE) for i in range(20)))
+        order.clear()
+        tasks = [asyncio.create_task(call(send(f"bulk{i}"), PRIORITY_BULK)) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(call(send(f"reply{i}"), PRIORITY_INTERACTIVE)) for i in range(3)]
+        await asyncio.gather(*tasks)
+        names = [name for name, _ in order]
+        print(f"Send order: {names}")
+
+        # RetryAfter pauses every call, not only the one that hit it
+        order.clear()
+        start = asyncio.get_running_loop().time()
+        flooded = asyncio.create_task(call(send("flooded", fail_once=True), PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0.1)
+        await call(send("other"), PRIORITY_INTERACTIVE, chat_id=2)
+        await flooded
+        waited = {name: at - start for name, at in order}
+        stats = limiter.stats()
+    finally:
+        await limiter.shutdown()
+    print(f"After RetryAfter(1): {waited}, stats: {stats}")
+
+    if names[:3] == ["reply0", "reply1", "reply2"] and names[3:] == ["bulk0", "bulk1", "bulk2"]:
+        print("[OK] Interactive calls overtake queued bulk calls")
+    else:
+        print("[FAILED] Priority order not respected")
+    if stats["retries"] == 1 and waited.get("flooded", 0) >= 0.9 and waited.get("other", 0) >= 0.9:
+        print("[OK] Test PASSED: RetryAfter paused all traffic and the call was retried")
+    else:
+        print("[FAILED] Test FAILED: RetryAfter not handled")
+
+
+async def test_broadcast_resume():
+    """Test that an interrupted broadcast resumes from its cursor"""
+    print("\n" + "="*50)
+    print("TEST 15: Broadcast Resume")
+    print("="*50)
+
+    import broadcast
+    from config import create_broadcast_job, get_broadcast_job, record_broadcast_chunk
+
+    class FakeBot:
+        def __init__(self):
+            self.sent, self.edits = [], []
+
+        async def send_message(self, chat_id, **kwargs):
+            self.sent.append(chat_id)
+
+        async def edit_message_text(self, text, **kwargs):
+            self.edits.append(text)
+
+    recipients = [uid async for uid in iter_user_ids()]
+    job_id = await create_broadcast_job(777023, 1, text="resume test")
+
+    # First run dies on its second chunk, after the first one was committed
+    chunks = {"n": 0}
+
+    async def failing_chunk(*args):
+        chunks["n"] += 1
+        if chunks["n"] == 2:
+            raise RuntimeError("simulated crash")
+        await record_broadcast_chunk(*args)
+
+    saved_chunk = broadcast.BROADCAST_CHUNK
+    broadcast.BROADCAST_CHUNK = 2
+    broadcast.record_broadcast_chunk = failing_chunk
+    try:
+        first = FakeBot()
+        await broadcast._run_guarded(first, job_id)
+        cursor = (await get_broadcast_job(job_id))["cursor"]
+        broadcast.record_broadcast_chunk = record_broadcast_chunk
+        second = FakeBot()
+        await broadcast._run_guarded(second, job_id)
+    finally:
+        broadcast.BROADCAST_CHUNK = saved_chunk
+        broadcast.record_broadcast_chunk = record_broadcast_chunk
+    job = await get_broadcast_job(job_id)
+    print(f"Recipients: {len(recipients)}, first run sent {len(first.sent)} (cursor {cursor}), resumed run sent {len(second.sent)}")
+
+    if first.edits and "interrupted" in first.edits[-1] and all(uid > cursor for uid in second.sent):
+        print("[OK] Crash reported, resume started after the committed cursor")
+    else:
+        print("[FAILED] Resume did not start from the cursor")
+    if job["state"] == "done" and job["success"] == len(recipients) and sorted(set(first.sent + second.sent)) == sorted(recipients):
+        print("[OK] Test PASSED: Every recipient counted once and reached")
+    else:
+        print(f"[FAILED] Test FAILED: {dict(job)}")
+
+
 async def main():
     """Run all tests"""
     print("\n" + "="*50)
@@ -131,6 +672,20 @@ async def main():
     await test_user_tracking()
     await test_get_all_users()
     await test_force_join_cache()
+    await test_transaction_rollback()
+    await test_stats_counters()
+    await test_episode_reservations()
+    await test_multi_rotation()
+    await test_caption_paging()
+    await test_media_context_cache()
+    await test_force_join_single_flight()
+    await test_transfer_scheduler()
+    await test_per_user_updates()
+    await test_ack_coalescing()
+    await test_outbound_limiter()
+    await test_broadcast_resume()
+
+    await close_db()
 
     print("\n" + "="*50)
     print("ALL TESTS COMPLETED")
@@ -0,0 +1,320 @@
+import asyncio
+import io
+import os
+import tempfile
+from collections import deque
+from urllib.parse import quote, urlsplit, urlunsplit
+
+import httpx
+
+from telegram import InputFile, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+from telegram.error import BadRequest
+
+from config import (
+	TRANSFER_SPOOL_MAX,
+	TRANSFER_WORKERS,
+	TRANSFER_MAX_BYTES,
+	TRANSFER_PER_USER,
+	TRANSFER_DRAIN_TIMEOUT,
+	get_cached_file_id,
+	put_cached_file_id,
+	forget_cached_file_id,
+	record_transfer,
+)
+from outbound import PRIORITY_MEDIA
+
+
+# -----------------------------
+# Document transfer
+# -----------------------------
+# Re-uploading a document under a new name needs its bytes, handed to the
+# upload as an open file handle (read_file_handle=False) so PTB doesn't copy
+# them. Documents up to TRANSFER_SPOOL_MAX are downloaded into RAM; larger
+# ones are streamed in chunks into a temp file, every disk write in a worker
+# thread. With a local Bot API server the file is already on disk and is
+# simply opened.
+
+async def open_document(document):
+	"""Readable handle on a document's content, positioned at 0. Close it with close_document()."""
+	tg_file = await document.get_file()
+	path = tg_file.file_path or ""
+	if tg_file.get_bot().local_mode and os.path.isabs(path):
+		return await asyncio.to_thread(open, path, "rb")
+	if (tg_file.file_size or document.file_size or 0) <= TRANSFER_SPOOL_MAX:
+		buf = io.BytesIO()
+		await tg_file.download_to_memory(out=buf)
+		buf.seek(0)
+		return buf
+	return await _download_to_tempfile(path)
+
+
+async def _download_to_tempfile(url: str):
+	# PTB downloads whole payloads into memory, so large files are streamed here
+	parts = urlsplit(url)
+	url = urlunsplit(parts._replace(path=quote(parts.path)))
+	fh = await asyncio.to_thread(tempfile.TemporaryFile, prefix="acb_")
+	try:
+		async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as client:
+			async with client.stream("GET", url) as resp:
+				resp.raise_for_status()
+				async for chunk in resp.aiter_bytes(1024 * 1024):
+					await asyncio.to_thread(fh.write, chunk)
+		await asyncio.to_thread(fh.seek, 0)
+	except BaseException:
+		await asyncio.to_thread(fh.close)
+		raise
+	return fh
+
+
+async def close_document(fh):
+	if isinstance(fh, io.BytesIO):
+		fh.close()
+	else:
+		await asyncio.to_thread(fh.close)
+
+
+def upload_file(fh, filename: str, attach: bool = False) -> InputFile:
+	"""Wrap an open_document() handle for upload without reading it into memory."""
+	return InputFile(fh, filename=filename, attach=attach, read_file_handle=False)
+
+
+async def resend_document(bot, chat_id: int, document, filename: str, caption: str):
+	"""
+	Send `document` back to `chat_id` as `filename` with `caption`.
+	Cheapest path first: the original file_id when the name is unchanged,
+	then the file_id of an earlier upload under the same name, and only then
+	a full transfer whose file_id is remembered. The path taken is recorded.
+	"""
+	size = document.file_size or 0
+	if filename == document.file_name:
+		# Nothing to rename: only the caption changes
+		sent = await bot.send_document(
+			chat_id=chat_id, document=document.file_id, caption=caption, rate_limit_args=PRIORITY_MEDIA
+		)
+		record_transfer("reuse", size)
+		return sent
+
+	unique_id = document.file_unique_id
+	cached = await get_cached_file_id(unique_id, filename)
+	if cached:
+		try:
+			sent = await bot.send_document(
+				chat_id=chat_id, document=cached, caption=caption, rate_limit_args=PRIORITY_MEDIA
+			)
+			record_transfer("cached", size)
+			return sent
+		except BadRequest:
+			# file_id no longer valid for this bot: drop it and transfer again
+			await forget_cached_file_id(unique_id, filename)
+
+	fh = await open_document(document)
+	try:
+		sent = await bot.send_document(
+			chat_id=chat_id,
+			document=upload_file(fh, filename),
+			caption=caption,
+			rate_limit_args=PRIORITY_MEDIA,
+		)
+	finally:
+		await close_document(fh)
+	record_transfer("upload", size)
+	if sent.document:
+		await put_cached_file_id(unique_id, filename, sent.document.file_id)
+	return sent
+
+
+async def resend_document_group(bot, chat_id: int, items: list):
+	"""
+	Album counterpart of resend_document: `items` is [(document, filename, caption)],
+	all sent back with one send_media_group. Each item takes the cheapest path
+	on its own; if Telegram rejects a cached file_id the group is rebuilt without them.
+	"""
+	use_cache = True
+	while True:
+		media, paths, handles = [], [], []
+		try:
+			for document, filename, caption in items:
+				if filename == document.file_name:
+					media.append(InputMediaDocument(document.file_id, caption=caption))
+					paths.append("reuse")
+					continue
+				cached = await get_cached_file_id(document.file_unique_id, filename) if use_cache else None
+				if cached:
+					media.append(InputMediaDocument(cached, caption=caption))
+					paths.append("cached")
+					continue
+				fh = await open_document(document)
+				handles.append(fh)
+				media.append(InputMediaDocument(upload_file(fh, filename, attach=True), caption=caption))
+				paths.append("upload")
+			sent = await bot.send_media_group(chat_id=chat_id, media=media, rate_limit_args=PRIORITY_MEDIA)
+			break
+		except BadRequest:
+			if "cached" not in paths:
+				raise
+			for (document, filename, _), path in zip(items, paths):
+				if path == "cached":
+					await forget_cached_file_id(document.file_unique_id, filename)
+			use_cache = False
+		finally:
+			for fh in handles:
+				await close_document(fh)
+
+	for (document, filename, _), path, message in zip(items, paths, sent):
+		record_transfer(path, document.file_size or 0)
+		if path == "upload" and message.document:
+			await put_cached_file_id(document.file_unique_id, filename, message.document.file_id)
+	return sent
+
+
+async def copy_media_group(bot, chat_id: int, messages: list, captions: list):
+	"""Send photo/video album items back by file_id with new captions, in one call."""
+	media = []
+	for msg, caption in zip(messages, captions):
+		if msg.photo:
+			media.append(InputMediaPhoto(msg.photo[-1].file_id, caption=caption))
+		elif msg.video:
+			media.append(InputMediaVideo(msg.video.file_id, caption=caption))
+		else:
+			raise ValueError("unsupported media in album")
+	sent = await bot.send_media_group(chat_id=chat_id, media=media, rate_limit_args=PRIORITY_MEDIA)
+	for _ in sent:
+		record_transfer("copy")
+	return sent
+
+
+# -----------------------------
+# Transfer workers
+# -----------------------------
+# Handlers submit jobs and return. A fixed pool of workers runs them with
+# three limits: TRANSFER_WORKERS jobs at once, TRANSFER_MAX_BYTES in flight
+# (a single larger job may still run alone), and TRANSFER_PER_USER jobs per
+# user. Users with pending work take turns on a ready queue, so one user's
+# backlog of 2 GB files cannot starve everybody else.
+# On shutdown the queue is drained; a job that cannot finish in time is
+# abandoned through its `cancel` callback (queued) or cancelled (running),
+# so it can give back what it reserved and tell the chat.
+_jobs: dict[int, deque] = {}        # user_id -> pending (size, run, cancel)
+_running: dict[int, int] = {}       # user_id -> jobs in progress
+_ready: asyncio.Queue | None = None  # user_ids that may start a job, round-robin
+_scheduled: set[int] = set()        # user_ids currently in _ready
+_bytes_in_flight = 0
+_bytes_cond: asyncio.Condition | None = None
+_workers: list[asyncio.Task] = []
+_idle = asyncio.Event()             # set while nothing is queued or running
+_idle.set()
+
+
+def start_workers(count: int = TRANSFER_WORKERS):
+	global _ready, _bytes_cond
+	if _workers:
+		return
+	_ready = asyncio.Queue()
+	_bytes_cond = asyncio.Condition()
+	for uid, pending in _jobs.items():
+		if pending:
+			_schedule(uid)
+	for _ in range(max(1, count)):
+		_workers.append(asyncio.create_task(_worker()))
+
+
+async def stop_workers(timeout: float = TRANSFER_DRAIN_TIMEOUT):
+	"""
+	Let queued and running jobs finish for up to `timeout` seconds, then stop
+	the workers. Must run while the bot can still send (post_stop).
+	"""
+	if _workers:
+		try:
+			await asyncio.wait_for(_idle.wait(), timeout)
+		except asyncio.TimeoutError:
+			print(f"transfer: {sum(map(len, _jobs.values()))} queued, {sum(_running.values())} running jobs abandoned")
+	abandoned = [job for pending in _jobs.values() for job in pending]
+	_jobs.clear()
+	_scheduled.clear()
+	while _workers:
+		task = _workers.pop()
+		task.cancel()
+		try:
+			await task
+		except asyncio.CancelledError:
+			pass
+	for _, _, cancel in abandoned:
+		if cancel is None:
+			continue
+		try:
+			await cancel()
+		except Exception as e:
+			print(f"transfer: abandoning a job failed: {e}")
+	_idle.set()
+
+
+def submit(user_id: int, size: int, run, cancel=None):
+	"""
+	Queue `run` (an async callable) for user_id; `size` is the bytes it may transfer.
+	`cancel` (async callable) is awaited instead if the job is dropped at shutdown.
+	"""
+	_jobs.setdefault(user_id, deque()).append((max(0, size or 0), run, cancel))
+	_idle.clear()
+	_schedule(user_id)
+
+
+def queue_stats() -> dict:
+	return {
+		"queued": sum(map(len, _jobs.values())),
+		"running": sum(_running.values()),
+		"bytes": _bytes_in_flight,
+	}
+
+
+def _schedule(user_id: int):
+	if _ready is None or user_id in _scheduled:
+		return
+	if _jobs.get(user_id) and _running.get(user_id, 0) < TRANSFER_PER_USER:
+		_scheduled.add(user_id)
+		_ready.put_nowait(user_id)
+
+
+async def _worker():
+	global _bytes_in_flight
+	while True:
+		user_id = await _ready.get()
+		_scheduled.discard(user_id)
+		pending = _jobs.get(user_id)
+		if not pending:
+			continue
+		size, run, cancel = pending.popleft()
+		if not pending:
+			del _jobs[user_id]
+		_running[user_id] = _running.get(user_id, 0) + 1
+		_schedule(user_id)  # more of this user's jobs may start if the cap allows
+		try:
+			try:
+				async with _bytes_cond:
+					await _bytes_cond.wait_for(
+						lambda: _bytes_in_flight == 0 or _bytes_in_flight + size <= TRANSFER_MAX_BYTES
+					)
+					_bytes_in_flight += size
+			except asyncio.CancelledError:
+				# Stopped before the job began: abandon it like a queued one
+				if cancel is not None:
+					try:
+						await cancel()
+					except Exception as e:
+						print(f"transfer: abandoning a job failed: {e}")
+				raise
+			try:
+				await run()
+			except Exception as e:
+				# Jobs report their own failures to the chat; this is a last resort
+				print(f"transfer job for {user_id} failed: {e}")
+			finally:
+				async with _bytes_cond:
+					_bytes_in_flight -= size
+					_bytes_cond.notify_all()
+		finally:
+			_running[user_id] -= 1
+			if not _running[user_id]:
+				del _running[user_id]
+			_schedule(user_id)
+			if not _jobs and not _running:
+				_idle.set()
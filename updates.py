@@ -0,0 +1,69 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from config import UPDATE_CONCURRENCY
+
+
+# -----------------------------
+# Per-user ordering
+# -----------------------------
+# Updates run concurrently, but those of one user go through that user's lock.
+# Different users proceed in parallel; one user's messages and callbacks keep
+# their arrival order (asyncio.Lock wakes waiters first-in, first-out, and
+# update tasks reach the lock in the order they were created).
+# A lock lives only while someone holds or waits for it, so idle users cost nothing.
+_locks: dict[int, list] = {}  # key -> [asyncio.Lock, holders + waiters]
+
+
+@asynccontextmanager
+async def user_lock(key: int):
+	"""Serialize work for `key`. Not reentrant: don't take it again from inside a handler."""
+	entry = _locks.get(key)
+	if entry is None:
+		entry = _locks[key] = [asyncio.Lock(), 0]
+	entry[1] += 1
+	try:
+		async with entry[0]:
+			yield
+	finally:
+		entry[1] -= 1
+		if not entry[1]:
+			del _locks[key]
+
+
+def _update_key(update: object):
+	if not isinstance(update, Update):
+		return None
+	if update.effective_user:
+		return update.effective_user.id
+	if update.effective_chat:
+		return update.effective_chat.id
+	return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+	"""
+	Concurrent update processing, serialized per user.
+	Updates waiting on their user's lock still count towards
+	max_concurrent_updates, so keep it well above the number of busy users.
+	"""
+
+	def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY):
+		super().__init__(max_concurrent_updates)
+
+	async def do_process_update(self, update, coroutine):
+		key = _update_key(update)
+		if key is None:
+			await coroutine
+			return
+		async with user_lock(key):
+			await coroutine
+
+	async def initialize(self):
+		pass
+
+	async def shutdown(self):
+		pass